@@ -161,10 +161,10 @@ You may copy it and use it as a template.
 import gettext
 import logging
 import os
+import threading
 import time
 from hashlib import sha1
 from functools import partial
-import StringIO
 import cairo
 import json
 
@@ -173,6 +173,7 @@ gi.require_version('Gtk', '3.0')
 gi.require_version('Gdk', '3.0')
 gi.require_version('SugarExt', '1.0')
 
+from gi.repository import GLib
 from gi.repository import GObject
 from gi.repository import Gdk
 from gi.repository import Gtk
@@ -196,6 +197,7 @@ from sugar3.graphics import style
 from sugar3.graphics.window import Window
 from sugar3.graphics.alert import Alert
 from sugar3.graphics.icon import Icon
+from sugar3.graphics.preview import encode_preview, PREVIEW_FORMAT_PNG
 from sugar3.datastore import datastore
 from sugar3.bundle.activitybundle import get_bundle_instance
 from sugar3.bundle.helpers import bundle_from_dir
@@ -225,6 +227,54 @@ PREVIEW_SIZE = style.zoom(300), style.zoom(225)
 Size of a preview image for journal object metadata.
 """
 
+# Milliseconds schedule_save() waits for further changes before saving
+_SAVE_DELAY = 1000
+
+
+def _render_preview(screenshot_surface, preview_size, encoding,
+                    previous_preview=None):
+    """Scale a grab of the canvas down to preview_size and encode it with
+    the (format, options) encoding given.  Only uses its own surfaces, so
+    it may run on a worker thread.
+
+    Returns a (digest, data) tuple.  If previous_preview, an earlier result,
+    has the same digest, its data is reused instead of encoding again.
+    """
+    canvas_width = screenshot_surface.get_width()
+    canvas_height = screenshot_surface.get_height()
+
+    preview_width, preview_height = preview_size
+    preview_surface = cairo.ImageSurface(cairo.FORMAT_ARGB32,
+                                         preview_width, preview_height)
+    cr = cairo.Context(preview_surface)
+
+    scale_w = preview_width * 1.0 / canvas_width
+    scale_h = preview_height * 1.0 / canvas_height
+    scale = min(scale_w, scale_h)
+
+    translate_x = int((preview_width - (canvas_width * scale)) / 2)
+    translate_y = int((preview_height - (canvas_height * scale)) / 2)
+
+    cr.translate(translate_x, translate_y)
+    cr.scale(scale, scale)
+
+    cr.set_source_rgba(1, 1, 1, 0)
+    cr.set_operator(cairo.OPERATOR_SOURCE)
+    cr.paint()
+    cr.set_source_surface(screenshot_surface)
+    cr.paint()
+    del cr
+
+    preview_surface.flush()
+    digest = sha1(preview_surface.get_data())
+    digest.update(repr(encoding))
+    digest = digest.digest()
+    if previous_preview is not None and previous_preview[0] == digest:
+        return previous_preview
+
+    preview_format, options = encoding
+    return digest, encode_preview(preview_surface, preview_format, **options)
+
 
 class _ActivitySession(GObject.GObject):
 
@@ -360,6 +410,17 @@ class Activity(Window, Gtk.Container):
         self.shared_activity = None
         self._join_id = None
         self._updating_jobject = False
+        self._save_pending = False
+        self._save_timeout_id = None
+        self._save_jobs = 0
+        self._save_error = None
+        self._copy_pending = False
+        # Set when the canvas is drawn, cleared when save() grabs a preview
+        self._canvas_damaged = True
+        self._canvas_draw_hid = None
+        self._last_preview = None
+        self._preview_size = PREVIEW_SIZE
+        self._preview_encoding = (PREVIEW_FORMAT_PNG, {})
         self._closing = False
         self._quit_requested = False
         self._deleting = False
@@ -662,9 +723,21 @@ class Activity(Window, Gtk.Container):
             canvas (:class:`Gtk.Widget`): the widget used as canvas
         '''
 
+        if self._canvas_draw_hid is not None:
+            self.canvas.disconnect(self._canvas_draw_hid)
+            self._canvas_draw_hid = None
+
         Window.set_canvas(self, canvas)
-        if not self._read_file_called:
-            canvas.connect('map', self.__canvas_map_cb)
+        if canvas is not None:
+            if not self._read_file_called:
+                canvas.connect('map', self.__canvas_map_cb)
+            self._canvas_draw_hid = canvas.connect('draw',
+                                                   self.__canvas_draw_cb)
+        self._canvas_damaged = True
+
+    def __canvas_draw_cb(self, canvas, cr):
+        self._canvas_damaged = True
+        return False
 
     canvas = property(get_canvas, set_canvas)
     '''
@@ -784,6 +857,37 @@ class Activity(Window, Gtk.Container):
         '''
         raise NotImplementedError
 
+    def get_save_snapshot(self):
+        '''
+        Subclasses may implement this method, together with
+        :meth:`write_snapshot`, instead of :meth:`write_file`, so that
+        writing large documents does not block the user interface.
+
+        It is called on the main loop when saving, and should quickly
+        return a copy of the document state that is independent from the
+        widgets and from later changes.
+
+        Returns:
+            object: the snapshot handed to :meth:`write_snapshot`, or None
+            if there is nothing to write
+        '''
+        raise NotImplementedError
+
+    def write_snapshot(self, snapshot, file_path):
+        '''
+        Write a snapshot returned by :meth:`get_save_snapshot` to
+        file_path, as :meth:`write_file` would.
+
+        It is called from a worker thread, so it must not touch any widget
+        or other state of the activity.  The journal object is written once
+        it returns; an exception fails the save.
+
+        Args:
+            snapshot (object): the snapshot to write
+            file_path (str): complete path of the file to write
+        '''
+        raise NotImplementedError
+
     def notify_user(self, summary, body):
         '''
         Display a notification with the given summary and body.
@@ -799,9 +903,23 @@ class Activity(Window, Gtk.Container):
         notifications.Notify(self.get_id(), 0, '', summary, body, [],
                              {'x-sugar-icon-file-name': icon}, -1)
 
-    def __save_cb(self):
+    def __save_cb(self, object_id=None):
         logging.debug('Activity.__save_cb')
         self._updating_jobject = False
+        if self._save_pending:
+            self._save_pending = False
+            try:
+                self.save()
+            except:
+                # pylint: disable=W0702
+                logging.exception('Error saving activity object to datastore')
+                if self._closing or self._quit_requested:
+                    # The dialog response completes the close or the quit
+                    self._closing = False
+                    self._show_keep_failed_dialog()
+                    return
+            if self._updating_jobject:
+                return
         if self._quit_requested:
             self._session.will_quit(self, True)
         elif self._closing:
@@ -810,6 +928,7 @@ class Activity(Window, Gtk.Container):
     def __save_error_cb(self, err):
         logging.debug('Activity.__save_error_cb')
         self._updating_jobject = False
+        self._save_pending = False
         if self._quit_requested:
             self._session.will_quit(self, False)
         if self._closing:
@@ -835,16 +954,44 @@ class Activity(Window, Gtk.Container):
         is seeing at the time.
 
         Returns:
-            str: image data in PNG format
+            str: image data in the format chosen with
+            :meth:`set_preview_format`, PNG by default
 
         Activities may override this method, and return a string with
         image data in PNG format with a width and height of
         :attr:`~sugar3.activity.activity.PREVIEW_SIZE` pixels.
 
-        The method creates a Cairo surface similar to that of the
-        :ref:`Gdk.Window` of the :meth:`canvas` widget, draws on it,
-        then resizes to a surface with the preview size.
+        The method draws the :meth:`canvas` widget on an image surface,
+        then resizes it to a surface with the preview size.  Unless this
+        method is overridden, :meth:`save` only draws the canvas on the
+        main loop and does the resizing and encoding on a worker thread.
+        '''
+        screenshot_surface = self._grab_canvas()
+        if screenshot_surface is None:
+            return None
+
+        return _render_preview(screenshot_surface, self._preview_size,
+                               self._preview_encoding)[1]
+
+    def set_preview_format(self, preview_format, size=None, **options):
         '''
+        Choose how the journal previews of this activity are encoded.
+
+        Args:
+            preview_format (str): one of the formats of
+                :mod:`sugar3.graphics.preview`, PNG by default
+            size (tuple): width and height of the preview, defaults to
+                :attr:`~sugar3.activity.activity.PREVIEW_SIZE`
+            **options: encoder options, compression (0 to 9) for PNG or
+                quality (0 to 100) for JPEG
+        '''
+        if size is None:
+            size = PREVIEW_SIZE
+        self._preview_size = size
+        self._preview_encoding = (preview_format, options)
+        self._canvas_damaged = True
+
+    def _grab_canvas(self):
         if self.canvas is None or not hasattr(self.canvas, 'get_window'):
             return None
 
@@ -853,13 +1000,8 @@ class Activity(Window, Gtk.Container):
             return None
 
         alloc = self.canvas.get_allocation()
-
-        dummy_cr = Gdk.cairo_create(window)
-        target = dummy_cr.get_target()
-        canvas_width, canvas_height = alloc.width, alloc.height
-        screenshot_surface = target.create_similar(cairo.CONTENT_COLOR,
-                                                   canvas_width, canvas_height)
-        del dummy_cr, target
+        screenshot_surface = cairo.ImageSurface(cairo.FORMAT_RGB24,
+                                                alloc.width, alloc.height)
 
         cr = cairo.Context(screenshot_surface)
         r, g, b, a_ = style.COLOR_PANEL_GREY.get_rgba()
@@ -868,30 +1010,14 @@ class Activity(Window, Gtk.Container):
         self.canvas.draw(cr)
         del cr
 
-        preview_width, preview_height = PREVIEW_SIZE
-        preview_surface = cairo.ImageSurface(cairo.FORMAT_ARGB32,
-                                             preview_width, preview_height)
-        cr = cairo.Context(preview_surface)
-
-        scale_w = preview_width * 1.0 / canvas_width
-        scale_h = preview_height * 1.0 / canvas_height
-        scale = min(scale_w, scale_h)
-
-        translate_x = int((preview_width - (canvas_width * scale)) / 2)
-        translate_y = int((preview_height - (canvas_height * scale)) / 2)
-
-        cr.translate(translate_x, translate_y)
-        cr.scale(scale, scale)
-
-        cr.set_source_rgba(1, 1, 1, 0)
-        cr.set_operator(cairo.OPERATOR_SOURCE)
-        cr.paint()
-        cr.set_source_surface(screenshot_surface)
-        cr.paint()
+        return screenshot_surface
 
-        preview_str = StringIO.StringIO()
-        preview_surface.write_to_png(preview_str)
-        return preview_str.getvalue()
+    def _is_canvas_damaged(self):
+        # The canvas is not drawn while hidden, so the draw signal can
+        # only be trusted while the activity is active and mapped
+        if not self._active or not self.canvas.get_mapped():
+            return True
+        return self._canvas_damaged
 
     def _get_buddies(self):
         if self.shared_activity is not None:
@@ -921,8 +1047,14 @@ class Activity(Window, Gtk.Container):
 
         logging.debug('Activity.save: %r' % self._jobject.object_id)
 
+        if self._save_timeout_id is not None:
+            GObject.source_remove(self._save_timeout_id)
+            self._save_timeout_id = None
+
         if self._updating_jobject:
-            logging.info('Activity.save: still processing a previous request.')
+            logging.info('Activity.save: still processing a previous request, '
+                         'saving again once it is done.')
+            self._save_pending = True
             return
 
         buddies_dict = self._get_buddies()
@@ -943,9 +1075,19 @@ class Activity(Window, Gtk.Container):
         self.metadata['spent-times'] = set_last_value(
             self.metadata['spent-times'], self._spent_time)
 
-        preview = self.get_preview()
-        if preview is not None:
-            self.metadata['preview'] = dbus.ByteArray(preview)
+        screenshot_surface = None
+        if self.get_preview.__func__ is Activity.get_preview.__func__:
+            if self.canvas is None or self._is_canvas_damaged() or \
+                    'preview' not in self.metadata:
+                screenshot_surface = self._grab_canvas()
+                self._canvas_damaged = False
+            else:
+                logging.debug('Activity.save: canvas unchanged, keeping the '
+                              'preview')
+        else:
+            preview = self.get_preview()
+            if preview is not None:
+                self.metadata['preview'] = dbus.ByteArray(preview)
 
         if not self.metadata.get('activity_id', ''):
             self.metadata['activity_id'] = self.get_id()
@@ -953,24 +1095,118 @@ class Activity(Window, Gtk.Container):
         file_path = os.path.join(get_activity_root(), 'instance',
                                  '%i' % time.time())
         try:
-            self.write_file(file_path)
+            snapshot = self.get_save_snapshot()
         except NotImplementedError:
-            logging.debug('Activity.write_file is not implemented.')
-        else:
-            if os.path.exists(file_path):
-                self._owns_file = True
-                self._jobject.file_path = file_path
+            snapshot = None
+            try:
+                self.write_file(file_path)
+            except NotImplementedError:
+                logging.debug('Activity.write_file is not implemented.')
+            else:
+                self.__file_written(file_path)
+
+        self._updating_jobject = True
+        if snapshot is not None:
+            self._add_save_job(self.write_snapshot, (snapshot, file_path),
+                               partial(self.__snapshot_written_cb, file_path))
+        if screenshot_surface is not None:
+            self._add_save_job(_render_preview,
+                               (screenshot_surface, self._preview_size,
+                                self._preview_encoding, self._last_preview),
+                               self.__preview_rendered_cb)
+        self._write_jobject()
+
+    def _add_save_job(self, job, args, callback):
+        '''
+        Run job(*args) on a worker thread as part of the save in progress.
+
+        callback(result, error) is called from the main loop once the job
+        is done; the journal object is written when all the jobs of the
+        save are done.  A callback may set self._save_error to fail the
+        save.
+        '''
+        self._save_jobs += 1
 
-        # Cannot call datastore.write async for creates:
-        # https://dev.laptop.org/ticket/3071
-        if self._jobject.object_id is None:
-            datastore.write(self._jobject, transfer_ownership=True)
+        def run():
+            result = None
+            error = None
+            try:
+                result = job(*args)
+            except Exception, e:
+                logging.exception('Activity save job failed')
+                error = e
+            GLib.idle_add(self.__save_job_done_cb, callback, result, error)
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+
+    def __save_job_done_cb(self, callback, result, error):
+        self._save_jobs -= 1
+        callback(result, error)
+        self._write_jobject()
+        return False
+
+    def __file_written(self, file_path):
+        if os.path.exists(file_path):
+            self._owns_file = True
+            self._jobject.file_path = file_path
+
+    def __snapshot_written_cb(self, file_path, result, error):
+        if error is not None:
+            self._save_error = error
+            if os.path.exists(file_path):
+                os.remove(file_path)
         else:
-            self._updating_jobject = True
-            datastore.write(self._jobject,
-                            transfer_ownership=True,
-                            reply_handler=self.__save_cb,
-                            error_handler=self.__save_error_cb)
+            self.__file_written(file_path)
+
+    def __preview_rendered_cb(self, preview, error):
+        if preview is None:
+            self._canvas_damaged = True
+        elif preview is not self._last_preview:
+            self._last_preview = preview
+            self.metadata['preview'] = dbus.ByteArray(preview[1])
+
+    def _write_jobject(self):
+        if self._save_jobs > 0:
+            return
+
+        if self._save_error is not None:
+            error = self._save_error
+            self._save_error = None
+            self._copy_pending = False
+            self.__save_error_cb(error)
+            return
+
+        datastore.write(self._jobject,
+                        transfer_ownership=True,
+                        reply_handler=self.__save_cb,
+                        error_handler=self.__save_error_cb)
+
+        if self._copy_pending:
+            self._copy_pending = False
+            self._jobject.object_id = None
+
+    def schedule_save(self, delay=_SAVE_DELAY):
+        '''
+        Save to the journal after a short delay.
+
+        Calls made before the delay expires are merged into a single
+        :meth:`save`, so widgets may call this on every edit.  A scheduled
+        save is flushed when the activity closes.
+
+        Args:
+            delay (int): milliseconds to wait for further changes
+        '''
+        if self._save_timeout_id is not None:
+            GObject.source_remove(self._save_timeout_id)
+        self._save_timeout_id = GObject.timeout_add(delay,
+                                                    self.__save_timeout_cb)
+
+    def __save_timeout_cb(self):
+        self._save_timeout_id = None
+        self.save()
+        return False
 
     def copy(self):
         '''
@@ -986,7 +1222,11 @@ class Activity(Window, Gtk.Container):
         '''
         logging.debug('Activity.copy: %r' % self._jobject.object_id)
         self.save()
-        self._jobject.object_id = None
+        if self._save_jobs > 0:
+            # the journal object is written once the save jobs are done
+            self._copy_pending = True
+        else:
+            self._jobject.object_id = None
 
     def __privacy_changed_cb(self, shared_activity, param_spec):
         logging.debug('__privacy_changed_cb %r' %
@@ -1249,6 +1489,9 @@ class Activity(Window, Gtk.Container):
         return label, tip
 
     def _prepare_close(self, skip_save=False):
+        if self._save_timeout_id is not None:
+            skip_save = False
+
         if not skip_save:
             try:
                 self.save()
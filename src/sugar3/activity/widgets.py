@@ -233,7 +233,7 @@ class TitleEntry(Gtk.ToolItem):
 
         activity.metadata['title'] = title
         activity.metadata['title_set_by_user'] = '1'
-        activity.save()
+        activity.schedule_save()
 
         activity.set_title(title)
 
@@ -320,7 +320,7 @@ class DescriptionItem(ToolButton):
             return
 
         activity.metadata['description'] = description
-        activity.save()
+        activity.schedule_save()
         return False
 
 
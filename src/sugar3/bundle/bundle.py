@@ -20,9 +20,11 @@
 UNSTABLE.
 """
 
+import io
 import os
 import logging
 import shutil
+import struct
 import StringIO
 import zipfile
 
@@ -51,6 +53,105 @@ class MalformedBundleException(Exception):
     pass
 
 
+class _ZipMemberReader(io.RawIOBase):
+    """Seekable reader over the data of a stored (uncompressed) zip member"""
+
+    def __init__(self, f, start, size):
+        io.RawIOBase.__init__(self)
+        self._file = f
+        self._start = start
+        self._size = size
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self._size
+        self._position = max(0, offset)
+        return self._position
+
+    def readinto(self, b):
+        length = min(len(b), self._size - self._position)
+        if length <= 0:
+            return 0
+        self._file.seek(self._start + self._position)
+        data = self._file.read(length)
+        b[:len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self._file.close()
+        io.RawIOBase.close(self)
+
+
+class _InflatingReader(io.RawIOBase):
+    """Forward-only reader over a compressed zip member, which also
+    closes the archive file when closed"""
+
+    def __init__(self, f, member_file):
+        io.RawIOBase.__init__(self)
+        self._file = f
+        self._member_file = member_file
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = self._member_file.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self._member_file.close()
+            self._file.close()
+        io.RawIOBase.close(self)
+
+
+def open_zip_member(f, name, buffer_size=io.DEFAULT_BUFFER_SIZE):
+    """Open a member of the zip archive in the binary file object given.
+
+    Stored members are read straight from the archive through a buffered,
+    seekable reader; compressed members are inflated on the fly and can
+    only be read forward.  The returned reader takes ownership of f.
+    Raises KeyError if there is no such member.
+    """
+    try:
+        zip_file = zipfile.ZipFile(f)
+        info = zip_file.getinfo(name)
+    except:
+        # pylint: disable=W0702
+        f.close()
+        raise
+
+    if info.compress_type != zipfile.ZIP_STORED or \
+            info.flag_bits & 0x1:
+        return io.BufferedReader(_InflatingReader(f, zip_file.open(info)),
+                                 buffer_size)
+
+    f.seek(info.header_offset)
+    header = struct.unpack(zipfile.structFileHeader,
+                           f.read(zipfile.sizeFileHeader))
+    start = info.header_offset + zipfile.sizeFileHeader + \
+        header[zipfile._FH_FILENAME_LENGTH] + \
+        header[zipfile._FH_EXTRA_FIELD_LENGTH]
+
+    return io.BufferedReader(_ZipMemberReader(f, start, info.file_size),
+                             buffer_size)
+
+
 class Bundle(object):
     """A Sugar activity, content module, etc.
 
@@ -130,6 +231,25 @@ class Bundle(object):
 
         return f
 
+    def open_stream(self, filename):
+        """Return a buffered reader for a file of the bundle without
+        loading it in memory, or None if there is no such file.
+        """
+        if self._zip_file is None:
+            path = os.path.join(self._path, filename)
+            try:
+                return io.open(path, 'rb')
+            except IOError:
+                logging.debug("cannot open path %s" % path)
+                return None
+
+        path = os.path.join(self._zip_root_dir, filename)
+        try:
+            return open_zip_member(io.open(self._path, 'rb'), path)
+        except KeyError:
+            logging.debug('%s not found in zip %s.' % (filename, path))
+            return None
+
     def is_file(self, filename):
         if self._zip_file is None:
             path = os.path.join(self._path, filename)
@@ -20,11 +20,15 @@
 STABLE
 """
 
+import io
 import logging
+import mmap
 import time
 from datetime import datetime
 import os
 import tempfile
+import weakref
+from functools import partial
 from gi.repository import GObject
 from gi.repository import Gio
 import dbus
@@ -32,14 +36,31 @@ import dbus
 from sugar3 import env
 from sugar3 import mime
 from sugar3 import dispatch
+from sugar3.bundle.bundle import open_zip_member
 from sugar3.profile import get_color
+from sugar3.util import LRU
+from sugar3.util import SizedLRU
 
 DS_DBUS_SERVICE = 'org.laptop.sugar.DataStore'
 DS_DBUS_INTERFACE = 'org.laptop.sugar.DataStore'
 DS_DBUS_PATH = '/org/laptop/sugar/DataStore'
 
+# Milliseconds schedule_write() waits for further changes before writing
+_WRITE_DELAY = 500
+
 _data_store = None
 
+# Weak references to the live DSObjects by object_id and id() of the
+# object, updated from the single Updated signal handler instead of one
+# D-Bus match rule per object
+_tracked_objects = {}
+
+# Properties of recently used entries, kept up to date by the Created,
+# Updated and Deleted signals.  Previews are held separately, under a
+# byte budget, so they are evicted first.
+_properties_cache = LRU(200)
+_preview_cache = SizedLRU(2 * 1024 * 1024)
+
 
 def _get_data_store():
     global _data_store
@@ -56,17 +77,80 @@ def _get_data_store():
     return _data_store
 
 
+def _cache_properties(object_id, properties):
+    properties = dict(properties)
+    preview = properties.pop('preview', None)
+
+    _properties_cache[object_id] = (properties, preview is not None)
+    if preview is not None:
+        _preview_cache[object_id] = preview
+    elif object_id in _preview_cache:
+        del _preview_cache[object_id]
+
+
+def _invalidate_properties(object_id):
+    if object_id in _properties_cache:
+        del _properties_cache[object_id]
+    if object_id in _preview_cache:
+        del _preview_cache[object_id]
+
+
+def _fetch_properties(object_id):
+    properties = _get_data_store().get_properties(object_id, byte_arrays=True)
+    _cache_properties(object_id, properties)
+    return properties
+
+
+def _get_cached_properties(object_id):
+    """Return a copy of the cached properties of an entry, or None if they
+    are not cached, or if its preview has been evicted from the cache.
+    """
+    if object_id not in _properties_cache:
+        return None
+
+    properties, has_preview = _properties_cache[object_id]
+    properties = dict(properties)
+    if not has_preview:
+        return properties
+
+    preview = _preview_cache.get(object_id)
+    if preview is None:
+        return None
+    properties['preview'] = preview
+    return properties
+
+
+def _get_properties(object_id):
+    """Return a copy of the properties of an entry, from the cache when
+    possible.
+    """
+    properties = _get_cached_properties(object_id)
+    if properties is not None:
+        return properties
+
+    return dict(_fetch_properties(object_id))
+
+
 def __datastore_created_cb(object_id):
-    metadata = _get_data_store().get_properties(object_id, byte_arrays=True)
+    metadata = _fetch_properties(object_id)
     updated.send(None, object_id=object_id, metadata=metadata)
 
 
 def __datastore_updated_cb(object_id):
-    metadata = _get_data_store().get_properties(object_id, byte_arrays=True)
+    metadata = _fetch_properties(object_id)
+
+    refs = _tracked_objects.get(object_id)
+    if refs is not None:
+        for ref in refs.values():
+            ds_object = ref()
+            if ds_object is not None:
+                ds_object._update_metadata(metadata)
+
     updated.send(None, object_id=object_id, metadata=metadata)
 
 
 def __datastore_deleted_cb(object_id):
+    _invalidate_properties(object_id)
     deleted.send(None, object_id=object_id)
 
 created = dispatch.Signal()
@@ -74,6 +158,54 @@ deleted = dispatch.Signal()
 updated = dispatch.Signal()
 
 
+def _untrack_ref(object_id, key, ref):
+    refs = _tracked_objects.get(object_id)
+    if refs is not None and refs.get(key) is ref:
+        del refs[key]
+        if not refs:
+            del _tracked_objects[object_id]
+
+
+def _untrack_object(ds_object, object_id):
+    refs = _tracked_objects.get(object_id)
+    if refs is not None and id(ds_object) in refs:
+        _untrack_ref(object_id, id(ds_object), refs[id(ds_object)])
+
+
+def _track_object(ds_object, old_object_id, object_id):
+    if old_object_id is not None:
+        _untrack_object(ds_object, old_object_id)
+
+    if object_id is not None:
+        # Make sure the Updated signal handler is connected
+        _get_data_store()
+        key = id(ds_object)
+        # The entry goes away with the last object tracked for the id
+        ref = weakref.ref(ds_object,
+                          lambda ref: _untrack_ref(object_id, key, ref))
+        _tracked_objects.setdefault(object_id, {})[key] = ref
+
+
+def _open_stream(fd, member):
+    if fd is None:
+        return None
+    f = io.open(fd, 'rb')
+    if member is not None:
+        return open_zip_member(f, member)
+    return f
+
+
+def _map_file(fd):
+    if fd is None:
+        return None
+    try:
+        if os.fstat(fd).st_size == 0:
+            return None
+        return mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+    finally:
+        os.close(fd)
+
+
 class DSMetadata(GObject.GObject):
     """A representation of the metadata associated with a DS entry."""
     __gsignals__ = {
@@ -86,6 +218,7 @@ class DSMetadata(GObject.GObject):
             self._properties = {}
         else:
             self._properties = properties
+        self._dirty_keys = set()
 
         default_keys = ['activity', 'activity_id',
                         'mime_type', 'title_set_by_user']
@@ -99,10 +232,12 @@ class DSMetadata(GObject.GObject):
     def __setitem__(self, key, value):
         if key not in self._properties or self._properties[key] != value:
             self._properties[key] = value
+            self._dirty_keys.add(key)
             self.emit('updated')
 
     def __delitem__(self, key):
         del self._properties[key]
+        self._dirty_keys.add(key)
 
     def __contains__(self, key):
         return self._properties.__contains__(key)
@@ -131,13 +266,30 @@ class DSMetadata(GObject.GObject):
         for (key, value) in properties.items():
             self[key] = value
 
+    def get_dirty_keys(self):
+        """Return the keys set or deleted since they were last written"""
+        return set(self._dirty_keys)
+
+    def clear_dirty_keys(self, keys=None):
+        """Mark the keys given, or all keys, as written"""
+        if keys is None:
+            self._dirty_keys.clear()
+        else:
+            self._dirty_keys.difference_update(keys)
+
+    def mark_dirty_keys(self, keys):
+        """Mark the keys given as changed"""
+        self._dirty_keys.update(keys)
+
 
 class DSObject(object):
     """A representation of a DS entry."""
 
     def __init__(self, object_id, metadata=None, file_path=None):
-        self._update_signal_match = None
         self._object_id = None
+        # Bumped on every object id change, so a create reply can tell
+        # whether the object was detached while it was in flight
+        self._object_id_generation = 0
 
         self.set_object_id(object_id)
 
@@ -145,29 +297,34 @@ class DSObject(object):
         self._file_path = file_path
         self._destroyed = False
         self._owns_file = False
+        # Writes issued while an asynchronous create is in flight
+        self._creating = False
+        self._queued_writes = []
+        # State of writes scheduled with schedule_write()
+        self._write_timeout_id = None
+        self._write_options = None
+        self._write_handlers = []
+        self._write_in_flight = False
+        self._write_again = False
 
     def get_object_id(self):
         return self._object_id
 
     def set_object_id(self, object_id):
-        if self._update_signal_match is not None:
-            self._update_signal_match.remove()
-        if object_id is not None:
-            self._update_signal_match = _get_data_store().connect_to_signal(
-                'Updated', self.__object_updated_cb, arg0=object_id)
-
+        _track_object(self, self._object_id, object_id)
         self._object_id = object_id
+        self._object_id_generation += 1
 
     object_id = property(get_object_id, set_object_id)
 
-    def __object_updated_cb(self, object_id):
-        properties = _get_data_store().get_properties(self._object_id,
-                                                      byte_arrays=True)
-        self._metadata.update(properties)
+    def _update_metadata(self, properties):
+        if self._metadata is not None:
+            self._metadata.update(properties)
+            self._metadata.clear_dirty_keys(properties.keys())
 
     def get_metadata(self):
         if self._metadata is None and self.object_id is not None:
-            properties = _get_data_store().get_properties(self.object_id)
+            properties = _get_properties(self.object_id)
             metadata = DSMetadata(properties)
             self._metadata = metadata
         return self._metadata
@@ -194,11 +351,51 @@ class DSObject(object):
 
     file_path = property(get_file_path, set_file_path)
 
+    def get_file_descriptor(self):
+        """Return a read-only file descriptor for the file of this entry.
+
+        Unlike get_file_path(), no file is left behind in the profile: the
+        link the datastore hands out is opened and removed right away, so
+        the data stays accessible through the descriptor only.  The caller
+        is responsible for closing it.  Returns None if the entry has no
+        file.
+        """
+        if self._file_path or self.object_id is None:
+            if not self._file_path:
+                return None
+            return os.open(self._file_path, os.O_RDONLY)
+
+        file_path = _get_data_store().get_filename(self.object_id)
+        if not file_path:
+            return None
+        try:
+            return os.open(file_path, os.O_RDONLY)
+        finally:
+            os.remove(file_path)
+
+    def open_stream(self, member=None):
+        """Return a buffered, seekable reader for the file of this entry,
+        or None if it has no file.
+
+        If member is given, the file is read as a zip archive and a reader
+        for that member is returned instead, see
+        sugar3.bundle.bundle.open_zip_member().
+        """
+        return _open_stream(self.get_file_descriptor(), member)
+
+    def open_mmap(self):
+        """Return a read-only mmap of the file of this entry, or None if it
+        has no file or the file is empty.
+        """
+        return _map_file(self.get_file_descriptor())
+
     def destroy(self):
         if self._destroyed:
             logging.warning('This DSObject has already been destroyed!.')
             return
         self._destroyed = True
+        if self._object_id is not None:
+            _untrack_object(self, self._object_id)
         if self._file_path and self._owns_file:
             if os.path.isfile(self._file_path):
                 os.remove(self._file_path)
@@ -259,6 +456,23 @@ class RawObject(object):
 
     file_path = property(get_file_path)
 
+    def get_file_descriptor(self):
+        """Return a read-only file descriptor for the file itself, without
+        creating a symlink in the profile.  The caller is responsible for
+        closing it.
+        """
+        return os.open(self.object_id, os.O_RDONLY)
+
+    def open_stream(self, member=None):
+        """Return a buffered, seekable reader for the file, or for the
+        member given of the zip archive it contains.
+        """
+        return _open_stream(self.get_file_descriptor(), member)
+
+    def open_mmap(self):
+        """Return a read-only mmap of the file, or None if it is empty"""
+        return _map_file(self.get_file_descriptor())
+
     def destroy(self):
         if self._destroyed:
             logging.warning('This RawObject has already been destroyed!.')
@@ -290,7 +504,7 @@ def get(object_id):
     if object_id.startswith('/'):
         return RawObject(object_id)
 
-    metadata = _get_data_store().get_properties(object_id, byte_arrays=True)
+    metadata = _get_properties(object_id)
 
     ds_object = DSObject(object_id, DSMetadata(metadata), None)
     # TODO: register the object for updates
@@ -327,14 +541,66 @@ def _update_ds_entry(uid, properties, filename, transfer_ownership=False,
                                  filename, transfer_ownership)
 
 
-def _create_ds_entry(properties, filename, transfer_ownership=False):
+def _create_ds_entry(properties, filename, transfer_ownership=False,
+                     reply_handler=None, error_handler=None, timeout=-1):
+    if reply_handler and error_handler:
+        _get_data_store().create(dbus.Dictionary(properties), filename,
+                                 transfer_ownership,
+                                 reply_handler=reply_handler,
+                                 error_handler=error_handler,
+                                 timeout=timeout)
+        return None
+
     object_id = _get_data_store().create(dbus.Dictionary(properties), filename,
                                          transfer_ownership)
     return object_id
 
 
+def __create_reply_cb(ds_object, reply_handler, generation, object_id):
+    ds_object._creating = False
+    if ds_object._object_id_generation == generation:
+        ds_object.object_id = object_id
+        ds_object.metadata['uid'] = object_id
+        ds_object.metadata.clear_dirty_keys(['uid'])
+    else:
+        # the object id was reset while creating, as Activity.copy()
+        # does, so the object must not be attached to the new entry
+        logging.debug('Object detached while creating %s', object_id)
+    logging.debug('Written object %s to the datastore.', object_id)
+
+    queued_writes = ds_object._queued_writes
+    ds_object._queued_writes = []
+
+    reply_handler(object_id)
+    for args in queued_writes:
+        write(ds_object, *args)
+
+
+def __create_error_cb(ds_object, error_handler, dirty_keys, error):
+    ds_object._creating = False
+    ds_object.metadata.mark_dirty_keys(dirty_keys)
+
+    queued_writes = ds_object._queued_writes
+    ds_object._queued_writes = []
+
+    error_handler(error)
+    for args in queued_writes:
+        queued_error_handler = args[3]
+        if queued_error_handler is not None:
+            queued_error_handler(error)
+        else:
+            logging.error('Dropping write of an entry that could not be '
+                          'created: %s', error)
+
+
+def __update_error_cb(ds_object, error_handler, dirty_keys, error):
+    ds_object.metadata.mark_dirty_keys(dirty_keys)
+    error_handler(error)
+
+
 def write(ds_object, update_mtime=True, transfer_ownership=False,
-          reply_handler=None, error_handler=None, timeout=-1):
+          reply_handler=None, error_handler=None, timeout=-1,
+          only_changed=False):
     """Write the DSObject given to the datastore. Creates a new entry if
     the entry does not exist yet.
 
@@ -345,45 +611,188 @@ def write(ds_object, update_mtime=True, transfer_ownership=False,
                           be passed - who is responsible to delete the file
                           when done with it (default False)
     reply_handler -- will be called with the method's return values as
-                     arguments (default None)
+                     arguments; for a create that is the new object id,
+                     which is also set on ds_object (default None)
     error_handler -- will be called with an instance of a DBusException
                      representing a remote exception (default None)
     timeout -- dbus timeout for the caller to wait (default -1)
+    only_changed -- set it to true to skip updating an existing entry if
+                    none of its metadata was changed since it was last
+                    written and there is no file to write (default False)
+
+    Writes issued while an asynchronous create of the same object is still
+    pending are queued and sent as updates once the object id is known.
 
     """
     logging.debug('datastore.write')
 
-    properties = ds_object.metadata.get_dictionary().copy()
-
-    if update_mtime:
-        properties['mtime'] = datetime.now().isoformat()
-        properties['timestamp'] = int(time.time())
+    if ds_object._creating:
+        logging.debug('datastore.write: queued until the entry is created')
+        ds_object._queued_writes.append((update_mtime, transfer_ownership,
+                                         reply_handler, error_handler,
+                                         timeout, only_changed))
+        return
 
     file_path = ds_object.get_file_path(fetch=False)
     if file_path is None:
         file_path = ''
 
-    # FIXME: this func will be sync for creates regardless of the handlers
-    # supplied. This is very bad API, need to decide what to do here.
-    if ds_object.object_id:
+    metadata = ds_object.metadata
+    dirty_keys = metadata.get_dirty_keys()
+    if only_changed and ds_object.object_id and not dirty_keys and \
+            not file_path:
+        logging.debug('datastore.write: %s is unchanged', ds_object.object_id)
+        if reply_handler is not None:
+            reply_handler()
+        return
+
+    # The datastore replaces the whole metadata of an entry on update, so
+    # the full dictionary is always sent
+    properties = metadata.get_dictionary().copy()
+    metadata.clear_dirty_keys()
+
+    if update_mtime:
+        properties['mtime'] = datetime.now().isoformat()
+        properties['timestamp'] = int(time.time())
+
+    if ds_object.object_id and reply_handler and error_handler:
+        _invalidate_properties(ds_object.object_id)
         _update_ds_entry(ds_object.object_id,
                          properties,
                          file_path,
                          transfer_ownership,
                          reply_handler=reply_handler,
-                         error_handler=error_handler,
+                         error_handler=partial(__update_error_cb, ds_object,
+                                               error_handler, dirty_keys),
                          timeout=timeout)
-    else:
-        if reply_handler or error_handler:
-            logging.warning('datastore.write() cannot currently be called'
-                            'async for creates, see ticket 3071')
-        ds_object.object_id = _create_ds_entry(properties, file_path,
-                                               transfer_ownership)
-        ds_object.metadata['uid'] = ds_object.object_id
-        # TODO: register the object for updates
+        return
+    elif reply_handler and error_handler:
+        ds_object._creating = True
+        _create_ds_entry(properties, file_path, transfer_ownership,
+                         reply_handler=partial(
+                             __create_reply_cb, ds_object, reply_handler,
+                             ds_object._object_id_generation),
+                         error_handler=partial(__create_error_cb, ds_object,
+                                               error_handler, dirty_keys),
+                         timeout=timeout)
+        return
+
+    try:
+        if ds_object.object_id:
+            _invalidate_properties(ds_object.object_id)
+            _update_ds_entry(ds_object.object_id, properties, file_path,
+                             transfer_ownership)
+        else:
+            ds_object.object_id = _create_ds_entry(properties, file_path,
+                                                   transfer_ownership)
+            metadata['uid'] = ds_object.object_id
+            metadata.clear_dirty_keys(['uid'])
+    except:
+        # pylint: disable=W0702
+        metadata.mark_dirty_keys(dirty_keys)
+        raise
     logging.debug('Written object %s to the datastore.', ds_object.object_id)
 
 
+def schedule_write(ds_object, delay=_WRITE_DELAY, update_mtime=True,
+                   transfer_ownership=False, reply_handler=None,
+                   error_handler=None):
+    """Write the DSObject given to the datastore after a short delay.
+
+    Writes scheduled for the same object before the delay expires are
+    merged into a single asynchronous write of its latest state, and a
+    write scheduled while a previous one is still in flight is sent once
+    that one completes.  All the handlers given are called when the write
+    carrying their changes completes.
+
+    Keyword arguments:
+    delay -- milliseconds to wait for further changes (default 500)
+    update_mtime -- boolean if the mtime of the entry should be regenerated
+                    (default True)
+    transfer_ownership -- set it to true if the ownership of the entry should
+                          be passed (default False)
+    reply_handler -- will be called with the method's return values as
+                     arguments (default None)
+    error_handler -- will be called with an instance of a DBusException
+                     representing a remote exception (default None)
+
+    """
+    if ds_object._write_timeout_id is not None:
+        GObject.source_remove(ds_object._write_timeout_id)
+
+    if ds_object._write_options is not None:
+        update_mtime = update_mtime or ds_object._write_options[0]
+    ds_object._write_options = (update_mtime, transfer_ownership)
+    if reply_handler is not None or error_handler is not None:
+        ds_object._write_handlers.append((reply_handler, error_handler))
+
+    ds_object._write_timeout_id = GObject.timeout_add(
+        delay, __write_timeout_cb, ds_object)
+
+
+def flush_write(ds_object):
+    """Send the write scheduled for the DSObject given right away.
+
+    Returns True if a write is still pending for the object, either just
+    sent or already in flight.
+    """
+    if ds_object._write_timeout_id is not None:
+        GObject.source_remove(ds_object._write_timeout_id)
+        ds_object._write_timeout_id = None
+        _send_scheduled_write(ds_object)
+
+    return ds_object._write_in_flight
+
+
+def __write_timeout_cb(ds_object):
+    ds_object._write_timeout_id = None
+    _send_scheduled_write(ds_object)
+    return False
+
+
+def _send_scheduled_write(ds_object):
+    if ds_object._write_in_flight:
+        ds_object._write_again = True
+        return
+
+    update_mtime, transfer_ownership = ds_object._write_options
+    handlers = ds_object._write_handlers
+    ds_object._write_options = None
+    ds_object._write_handlers = []
+
+    ds_object._write_in_flight = True
+    write(ds_object, update_mtime, transfer_ownership,
+          reply_handler=partial(__scheduled_write_reply_cb, ds_object,
+                                handlers),
+          error_handler=partial(__scheduled_write_error_cb, ds_object,
+                                handlers))
+
+
+def __scheduled_write_reply_cb(ds_object, handlers, *args):
+    ds_object._write_in_flight = False
+    for reply_handler, error_handler in handlers:
+        if reply_handler is not None:
+            reply_handler(*args)
+    _send_next_scheduled_write(ds_object)
+
+
+def __scheduled_write_error_cb(ds_object, handlers, error):
+    ds_object._write_in_flight = False
+    logging.error('Scheduled write of %s failed: %s', ds_object.object_id,
+                  error)
+    for reply_handler, error_handler in handlers:
+        if error_handler is not None:
+            error_handler(error)
+    _send_next_scheduled_write(ds_object)
+
+
+def _send_next_scheduled_write(ds_object):
+    if ds_object._write_again:
+        ds_object._write_again = False
+        if ds_object._write_timeout_id is None:
+            _send_scheduled_write(ds_object)
+
+
 def delete(object_id):
     """Delete the datastore entry with the given uid.
 
@@ -392,9 +801,211 @@ def delete(object_id):
 
     """
     logging.debug('datastore.delete')
+    _invalidate_properties(object_id)
     _get_data_store().delete(object_id)
 
 
+class _BatchCall(object):
+    """Collects the results of asynchronous calls issued together.
+
+    Results are kept in the order of the calls; the position of a failed
+    call holds its exception.
+    """
+
+    def __init__(self, count, reply_handler=None, error_handler=None):
+        self._results = [None] * count
+        self._remaining = count
+        self._failed = False
+        self._started = False
+        self._reply_handler = reply_handler
+        self._error_handler = error_handler
+
+    def get_reply_handler(self, index, convert=None):
+        def reply_cb(*args):
+            result = args[0] if args else None
+            if convert is not None:
+                result = convert(result)
+            self.set_result(index, result)
+        return reply_cb
+
+    def get_error_handler(self, index):
+        def error_cb(error):
+            self._failed = True
+            self.set_result(index, error)
+        return error_cb
+
+    def set_result(self, index, result):
+        self._results[index] = result
+        self._remaining -= 1
+        if self._remaining == 0 and self._started:
+            self._complete()
+
+    def _complete(self):
+        if self._failed and self._error_handler is not None:
+            self._error_handler(self._results)
+        elif not self._failed and self._reply_handler is not None:
+            self._reply_handler(self._results)
+
+    def start(self):
+        """Call once all the calls have been issued"""
+        self._started = True
+        if self._remaining == 0:
+            self._complete()
+
+
+def _call_each(calls):
+    # Blocking form of the batched calls: one call after the other, without
+    # running the main loop, like the single object functions
+    results = []
+    for call in calls:
+        try:
+            results.append(call())
+        except dbus.DBusException, e:
+            results.append(e)
+    return results
+
+
+def _write_one(ds_object, update_mtime, transfer_ownership):
+    created = not ds_object.object_id
+    write(ds_object, update_mtime, transfer_ownership)
+    if created:
+        return ds_object.object_id
+    return None
+
+
+def get_many(object_ids, reply_handler=None, error_handler=None):
+    """Get the entries with the IDs given.  With handlers, their properties
+    are fetched with pipelined asynchronous D-Bus calls; without, with one
+    blocking call after the other.
+
+    Keyword arguments:
+    object_ids -- list of unique identifiers of the objects
+    reply_handler -- will be called with the list of DSObjects (default None)
+    error_handler -- will be called with the list of results if any of the
+                     calls failed, their positions holding the exceptions
+                     (default None)
+
+    Return: the list of results, failed positions holding the exceptions,
+    if no handler is given, None otherwise
+
+    """
+    logging.debug('datastore.get_many')
+
+    if reply_handler is None and error_handler is None:
+        return _call_each([partial(get, object_id)
+                           for object_id in object_ids])
+
+    batch = _BatchCall(len(object_ids), reply_handler, error_handler)
+
+    def create_ds_object(object_id, properties):
+        _cache_properties(object_id, properties)
+        return DSObject(object_id, DSMetadata(dict(properties)), None)
+
+    for index, object_id in enumerate(object_ids):
+        if object_id.startswith('/'):
+            batch.set_result(index, RawObject(object_id))
+            continue
+
+        # Only what is fully cached is served here, an entry with an
+        # evicted preview is fetched asynchronously like any other
+        properties = _get_cached_properties(object_id)
+        if properties is not None:
+            batch.set_result(index, DSObject(
+                object_id, DSMetadata(properties), None))
+        else:
+            _get_data_store().get_properties(
+                object_id, byte_arrays=True,
+                reply_handler=batch.get_reply_handler(
+                    index, partial(create_ds_object, object_id)),
+                error_handler=batch.get_error_handler(index))
+
+    batch.start()
+
+
+def write_many(ds_objects, update_mtime=True, transfer_ownership=False,
+               reply_handler=None, error_handler=None):
+    """Write the DSObjects given to the datastore, see write().  With
+    handlers, the writes are pipelined asynchronous D-Bus calls; without,
+    blocking calls made one after the other.
+
+    Keyword arguments:
+    ds_objects -- list of DSObjects to write
+    update_mtime -- boolean if the mtime of the entries should be
+                    regenerated (default True)
+    transfer_ownership -- set it to true if the ownership of the entries'
+                          files should be passed (default False)
+    reply_handler -- will be called with the list of results: the new
+                     object id for each create, None for each update
+                     (default None)
+    error_handler -- will be called with the list of results if any of the
+                     calls failed, their positions holding the exceptions
+                     (default None)
+
+    Return: the list of results, failed positions holding the exceptions,
+    if no handler is given, None otherwise
+
+    """
+    logging.debug('datastore.write_many')
+
+    if reply_handler is None and error_handler is None:
+        return _call_each([partial(_write_one, ds_object, update_mtime,
+                                   transfer_ownership)
+                           for ds_object in ds_objects])
+
+    batch = _BatchCall(len(ds_objects), reply_handler, error_handler)
+    for index, ds_object in enumerate(ds_objects):
+        write(ds_object, update_mtime, transfer_ownership,
+              reply_handler=batch.get_reply_handler(index),
+              error_handler=batch.get_error_handler(index))
+
+    batch.start()
+
+
+def delete_many(object_ids, reply_handler=None, error_handler=None):
+    """Delete the datastore entries with the uids given.  With handlers,
+    the deletes are pipelined asynchronous D-Bus calls; without, blocking
+    calls made one after the other.
+
+    Keyword arguments:
+    object_ids -- list of uids of the datastore entries
+    reply_handler -- will be called with the list of results (default None)
+    error_handler -- will be called with the list of results if any of the
+                     calls failed, their positions holding the exceptions
+                     (default None)
+
+    Return: the list of results, failed positions holding the exceptions,
+    if no handler is given, None otherwise
+
+    """
+    logging.debug('datastore.delete_many')
+
+    if reply_handler is None and error_handler is None:
+        return _call_each([partial(delete, object_id)
+                           for object_id in object_ids])
+
+    batch = _BatchCall(len(object_ids), reply_handler, error_handler)
+    for index, object_id in enumerate(object_ids):
+        _invalidate_properties(object_id)
+        _get_data_store().delete(object_id,
+                                 reply_handler=batch.get_reply_handler(index),
+                                 error_handler=batch.get_error_handler(index))
+
+    batch.start()
+
+
+def _build_query(query, sorting, limit, offset):
+    query = query.copy()
+
+    if sorting:
+        query['order_by'] = sorting
+    if limit:
+        query['limit'] = limit
+    if offset:
+        query['offset'] = offset
+
+    return query
+
+
 def find(query, sorting=None, limit=None, offset=None, properties=None,
          reply_handler=None, error_handler=None):
     """Find DS entries that match the query provided.
@@ -431,18 +1042,11 @@ def find(query, sorting=None, limit=None, offset=None, properties=None,
     Return: DSObjects matching the query, number of matches
 
     """
-    query = query.copy()
+    query = _build_query(query, sorting, limit, offset)
 
     if properties is None:
         properties = []
 
-    if sorting:
-        query['order_by'] = sorting
-    if limit:
-        query['limit'] = limit
-    if offset:
-        query['offset'] = offset
-
     if reply_handler and error_handler:
         _get_data_store().find(query, properties,
                                reply_handler=reply_handler,
@@ -463,6 +1067,171 @@ def find(query, sorting=None, limit=None, offset=None, properties=None,
     return ds_objects, total_count
 
 
+def _entries_to_columns(entries, properties):
+    columns = dict((key, []) for key in properties)
+    columns['uid'] = []
+    for entry in entries:
+        for key, column in columns.iteritems():
+            column.append(entry.get(key))
+    return columns
+
+
+def find_columns(query, properties, sorting=None, limit=None, offset=None,
+                 reply_handler=None, error_handler=None):
+    """Find DS entries that match the query provided, as columns.
+
+    Instead of a DSObject per entry, the result holds one list per
+    requested property, which is much cheaper for large listings.
+
+    Keyword arguments:
+    query -- a dictionary containing metadata key value pairs, see find()
+    properties -- list of the metadata to fetch e.g. ['title', 'timestamp']
+    sorting -- key to order results by e.g. 'timestamp' (default None)
+    limit -- return only limit results (default None)
+    offset -- return only results starting at offset (default None)
+    reply_handler -- will be called with the columns and the number of
+                     matches as arguments (default None)
+    error_handler -- will be called with an instance of a DBusException
+                     representing a remote exception (default None)
+
+    Return: a dictionary with a list of values per property, plus the 'uid'
+            list, a value is None when the entry does not have the property;
+            number of matches
+
+    """
+    query = _build_query(query, sorting, limit, offset)
+    properties = list(properties)
+    if 'uid' not in properties:
+        properties.append('uid')
+
+    if reply_handler and error_handler:
+        def find_reply_cb(entries, total_count):
+            reply_handler(_entries_to_columns(entries, properties),
+                          total_count)
+
+        _get_data_store().find(query, properties,
+                               reply_handler=find_reply_cb,
+                               error_handler=error_handler,
+                               byte_arrays=True)
+        return
+
+    entries, total_count = _get_data_store().find(query, properties,
+                                                  byte_arrays=True)
+    return _entries_to_columns(entries, properties), total_count
+
+
+class ResultCursor(object):
+    """A lazy sequence over the DS entries that match a query.
+
+    Results are fetched page by page with the limit and offset query keys,
+    and a DSObject is only built when an entry is accessed.  A new DSObject
+    is returned on every access, the caller is responsible for destroying
+    it.  Use find_cursor() to create a cursor.
+
+    """
+
+    def __init__(self, query, sorting=None, properties=None, page_size=50,
+                 prefetch=True):
+        self._query = query.copy()
+        if sorting:
+            self._query['order_by'] = sorting
+        if properties is None:
+            properties = []
+        self._properties = properties
+        self._page_size = page_size
+        self._prefetch = prefetch
+        self._pages = {}
+        self._pending_pages = set()
+        self._total_count = None
+
+    def _get_page_query(self, page):
+        query = self._query.copy()
+        query['limit'] = self._page_size
+        query['offset'] = page * self._page_size
+        return query
+
+    def _fetch_page(self, page):
+        entries, total_count = _get_data_store().find(
+            self._get_page_query(page), self._properties, byte_arrays=True)
+        self._pages[page] = entries
+        self._total_count = total_count
+
+    def _prefetch_page(self, page):
+        if not self._prefetch or page in self._pages or \
+                page in self._pending_pages or \
+                page * self._page_size >= self._total_count:
+            return
+
+        self._pending_pages.add(page)
+        _get_data_store().find(
+            self._get_page_query(page), self._properties,
+            reply_handler=partial(self.__prefetch_reply_cb, page),
+            error_handler=partial(self.__prefetch_error_cb, page),
+            byte_arrays=True)
+
+    def __prefetch_reply_cb(self, page, entries, total_count):
+        self._pending_pages.discard(page)
+        if page not in self._pages:
+            self._pages[page] = entries
+            self._total_count = total_count
+
+    def __prefetch_error_cb(self, page, error):
+        self._pending_pages.discard(page)
+        logging.error('Error prefetching datastore entries: %s', error)
+
+    def __len__(self):
+        if self._total_count is None:
+            self._fetch_page(0)
+        return self._total_count
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError('cursor index out of range')
+
+        page, position = divmod(index, self._page_size)
+        if page not in self._pages:
+            self._fetch_page(page)
+
+        entries = self._pages[page]
+        if position >= len(entries):
+            # The query matches fewer entries than when it was counted
+            raise IndexError('cursor index out of range')
+
+        self._prefetch_page(page + 1)
+
+        entry = dict(entries[position])
+        object_id = entry.pop('uid')
+        return DSObject(object_id, DSMetadata(entry), None)
+
+    def __iter__(self):
+        for index in xrange(len(self)):
+            try:
+                yield self[index]
+            except IndexError:
+                return
+
+
+def find_cursor(query, sorting=None, properties=None, page_size=50,
+                prefetch=True):
+    """Find DS entries that match the query provided, lazily.
+
+    Keyword arguments:
+    query -- a dictionary containing metadata key value pairs, see find()
+    sorting -- key to order results by e.g. 'timestamp' (default None)
+    properties -- you can specify here a list of metadata you want to be
+                  present in the result e.g. ['title, 'keep'] (default None)
+    page_size -- number of entries fetched per datastore call (default 50)
+    prefetch -- fetch the next page in the background when a page is
+                accessed (default True)
+
+    Return: a ResultCursor, that supports len(), indexing and iteration
+
+    """
+    return ResultCursor(query, sorting, properties, page_size, prefetch)
+
+
 def copy(ds_object, mount_point):
     """Copy a datastore entry
 
@@ -488,10 +1257,22 @@ def copy(ds_object, mount_point):
 
         new_ds_object.metadata['suggested_filename'] = filename
 
-    # this will cause the file be retrieved from the DS
-    new_ds_object.file_path = ds_object.file_path
+    transfer_ownership = False
+    if isinstance(ds_object, DSObject) and ds_object.object_id and \
+            ds_object.get_file_path(fetch=False) is None:
+        # fetch a link of our own and hand it over, so the datastore can
+        # move it into place instead of copying the file again
+        new_ds_object.file_path = \
+            _get_data_store().get_filename(ds_object.object_id)
+        transfer_ownership = True
+    else:
+        # this will cause the file be retrieved from the DS
+        new_ds_object.file_path = ds_object.file_path
 
-    write(new_ds_object)
+    write(new_ds_object, transfer_ownership=transfer_ownership)
+    if transfer_ownership:
+        # the link now belongs to the datastore, fetch again when needed
+        new_ds_object.file_path = None
 
     return new_ds_object
 
@@ -91,50 +91,575 @@ import re
 import math
 import logging
 import os
+import copy
+import mmap
+import Queue
+import threading
+import struct
+import hashlib
+import tempfile
 from ConfigParser import ConfigParser
+from functools import partial
 
 import gi
 gi.require_version('Rsvg', '2.0')
 gi.require_version('Gtk', '3.0')
 from gi.repository import GObject
+from gi.repository import GLib
 from gi.repository import Gtk
 from gi.repository import Gdk
 from gi.repository import GdkPixbuf
 from gi.repository import Rsvg
 import cairo
 
+from sugar3 import env
 from sugar3.graphics import style
 from sugar3.graphics.xocolor import XoColor
 from sugar3.util import LRU
+from sugar3.util import SizedLRU
 
 _BADGE_SIZE = 0.45
 
+_INSENSITIVE_ALPHA = 0.5
+
+_DEFAULT_SURFACE_CACHE_SIZE = 4 * 1024 * 1024
+
+_DISK_CACHE_SIZE = 16 * 1024 * 1024
+
+
+def _get_surface_cache_size():
+    size = os.environ.get('SUGAR_ICON_CACHE_SIZE')
+    if size is None:
+        return _DEFAULT_SURFACE_CACHE_SIZE
+
+    try:
+        return int(size)
+    except ValueError:
+        logging.error('Invalid SUGAR_ICON_CACHE_SIZE %r', size)
+        return _DEFAULT_SURFACE_CACHE_SIZE
+
+
+def _get_surface_size(surface):
+    return surface.get_width() * surface.get_height() * 4
+
+
+def _create_insensitive_surface(surface, background_color=None):
+    width = surface.get_width()
+    height = surface.get_height()
+
+    # Drop the saturation of the icon, masking with the icon itself so
+    # the transparent pixels stay transparent
+    grey_surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+    context = cairo.Context(grey_surface)
+    context.set_source_surface(surface, 0, 0)
+    context.paint()
+    context.set_operator(cairo.OPERATOR_HSL_SATURATION)
+    context.set_source_rgb(0.5, 0.5, 0.5)
+    context.mask_surface(surface, 0, 0)
+
+    if background_color is None:
+        insensitive = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+        context = cairo.Context(insensitive)
+    else:
+        insensitive = cairo.ImageSurface(cairo.FORMAT_RGB24, width, height)
+        context = cairo.Context(insensitive)
+        context.set_source_color(background_color)
+        context.paint()
+
+    context.set_source_surface(grey_surface, 0, 0)
+    context.paint_with_alpha(_INSENSITIVE_ALPHA)
+
+    return insensitive
+
+
+class _SVGTemplate(object):
+    '''
+    The text of an SVG file split around its entity declarations.  The
+    declarations are located once, and every colour variant is produced
+    by joining the precomputed slices.
+    '''
+
+    _ENTITY_RE = re.compile('<!ENTITY (\\S+) .*>')
+
+    def __init__(self, data):
+        self._slices = []
+        self._entities = []
+
+        position = 0
+        for match in self._ENTITY_RE.finditer(data):
+            self._slices.append(data[position:match.start()])
+            self._entities.append((match.group(1), match.group(0)))
+            position = match.end()
+        self._slices.append(data[position:])
+
+    def substitute(self, entities):
+        parts = []
+        for text, (name, declaration) in zip(self._slices, self._entities):
+            parts.append(text)
+            if name in entities:
+                parts.append('<!ENTITY %s "%s">' % (name, entities[name]))
+            else:
+                parts.append(declaration)
+        parts.append(self._slices[-1])
+
+        return ''.join(parts)
+
 
 class _SVGLoader(object):
 
     def __init__(self):
         self._cache = LRU(100)
+        self._handle_cache = LRU(50)
+        self.handle_hits = 0
+        self.handle_misses = 0
 
-    def load(self, file_name, entities, cache):
+    def _get_template(self, file_name, cache):
         if file_name in self._cache:
-            icon = self._cache[file_name]
-        else:
-            icon_file = open(file_name, 'r')
-            icon = icon_file.read()
-            icon_file.close()
+            return self._cache[file_name]
+
+        icon_file = open(file_name, 'r')
+        template = _SVGTemplate(icon_file.read())
+        icon_file.close()
 
-            if cache:
-                self._cache[file_name] = icon
+        if cache:
+            self._cache[file_name] = template
 
+        return template
+
+    def load(self, file_name, entities, cache):
+        values = {}
         for entity, value in entities.items():
             if isinstance(value, basestring):
-                xml = '<!ENTITY %s "%s">' % (entity, value)
-                icon = re.sub('<!ENTITY %s .*>' % entity, xml, icon)
+                values[entity] = value
             else:
                 logging.error(
                     'Icon %s, entity %s is invalid.', file_name, entity)
 
-        return Rsvg.Handle.new_from_data(icon.encode('utf-8'))
+        # Parsed handles can be rendered at any size, so they are kept
+        # for every colour variant, keyed on the file mtime in case the
+        # file is rewritten in place
+        try:
+            mtime = os.stat(file_name).st_mtime
+        except OSError:
+            mtime = None
+        key = (file_name, mtime, tuple(sorted(values.items())))
+
+        if key in self._handle_cache:
+            self.handle_hits += 1
+            return self._handle_cache[key]
+        self.handle_misses += 1
+
+        icon = self._get_template(file_name, cache).substitute(values)
+        handle = Rsvg.Handle.new_from_data(icon.encode('utf-8'))
+
+        if mtime is not None:
+            self._handle_cache[key] = handle
+
+        return handle
+
+    def get_stats(self):
+        return {'handle_hits': self.handle_hits,
+                'handle_misses': self.handle_misses,
+                'handles': len(self._handle_cache)}
+
+
+class _SurfaceDiskCache(object):
+    '''
+    Keeps rendered icon surfaces in the profile directory, so they are
+    shared between activity processes and survive restarts.
+
+    Each file holds the raw pixel data followed by a small trailer that
+    describes the surface, so the pixels can be mapped straight into a
+    cairo surface.  Entries are keyed on the surface cache key and on the
+    modification time of the source file, so changed icons are rendered
+    again.
+
+    Files are written from a low priority idle handler, and the directory
+    is kept under max_size bytes by removing the least recently used
+    files, going by their modification time, which load() refreshes.
+    '''
+
+    _MAGIC = 'SIC1'
+    _TRAILER = struct.Struct('<4siiii')
+
+    def __init__(self, max_size=_DISK_CACHE_SIZE):
+        self._path = None
+        self._max_size = max_size
+        self._size = None
+
+    def _get_path(self):
+        if self._path is None:
+            path = env.get_profile_path('icon-cache')
+            if not os.path.isdir(path):
+                try:
+                    os.makedirs(path)
+                except OSError:
+                    logging.warning('Could not create the icon cache %s',
+                                    path)
+            self._path = path
+        return self._path
+
+    def _prune(self):
+        path = self._get_path()
+        entries = []
+        try:
+            for file_name in os.listdir(path):
+                file_path = os.path.join(path, file_name)
+                stat = os.stat(file_path)
+                entries.append((stat.st_mtime, stat.st_size, file_path))
+        except OSError:
+            logging.exception('Could not list the icon cache %s', path)
+            return
+
+        self._size = sum(size for mtime_, size, file_path_ in entries)
+        if self._size <= self._max_size:
+            return
+
+        # Leave some room, so pruning does not happen on every write
+        entries.sort()
+        for mtime_, size, file_path in entries:
+            if self._size <= self._max_size * 3 / 4:
+                break
+            try:
+                os.remove(file_path)
+            except OSError:
+                continue
+            self._size -= size
+
+    def _get_file_path(self, key, source_file_name):
+        try:
+            mtime = os.stat(source_file_name).st_mtime
+        except OSError:
+            return None
+
+        digest = hashlib.sha1(repr((key, source_file_name, mtime)))
+        return os.path.join(self._get_path(), digest.hexdigest())
+
+    def load(self, key, source_file_name):
+        path = self._get_file_path(key, source_file_name)
+        if path is None:
+            return None
+
+        try:
+            with open(path, 'rb') as cache_file:
+                cache_file.seek(-self._TRAILER.size, os.SEEK_END)
+                magic, surface_format, width, height, stride = \
+                    self._TRAILER.unpack(cache_file.read(self._TRAILER.size))
+                if magic != self._MAGIC:
+                    return None
+                data = mmap.mmap(cache_file.fileno(), stride * height,
+                                 access=mmap.ACCESS_COPY)
+            os.utime(path, None)
+        except (IOError, OSError, ValueError, struct.error):
+            return None
+
+        return cairo.ImageSurface.create_for_data(data, surface_format,
+                                                  width, height, stride)
+
+    def store(self, key, source_file_name, surface):
+        # May be called from the render thread, idle_add() is thread safe
+        GLib.idle_add(self.__store_idle_cb, key, source_file_name, surface,
+                      priority=GLib.PRIORITY_LOW)
+
+    def __store_idle_cb(self, key, source_file_name, surface):
+        self._write(key, source_file_name, surface)
+        return False
+
+    def _write(self, key, source_file_name, surface):
+        path = self._get_file_path(key, source_file_name)
+        if path is None:
+            return
+
+        if self._size is None:
+            self._prune()
+
+        surface.flush()
+        trailer = self._TRAILER.pack(self._MAGIC, surface.get_format(),
+                                     surface.get_width(),
+                                     surface.get_height(),
+                                     surface.get_stride())
+
+        # Write to a temporary file and rename it, so other processes
+        # never map a partially written surface
+        try:
+            fd, temp_path = tempfile.mkstemp(dir=self._get_path())
+        except OSError:
+            return
+
+        try:
+            with os.fdopen(fd, 'wb') as cache_file:
+                cache_file.write(surface.get_data())
+                cache_file.write(trailer)
+            os.rename(temp_path, path)
+        except (IOError, OSError):
+            logging.exception('Could not write icon cache file %s', path)
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return
+
+        self._size += surface.get_stride() * surface.get_height() + \
+            self._TRAILER.size
+        if self._size > self._max_size:
+            self._prune()
+
+
+def _get_attach_points(info, size_request):
+    has_attach_points_, attach_points = info.get_attach_points()
+    attach_x = attach_y = 0
+    if attach_points:
+        # this works only for Gtk < 3.14
+        # https://developer.gnome.org/gtk3/stable/GtkIconTheme.html
+        # #gtk-icon-info-get-attach-points
+        attach_x = float(attach_points[0].x) / size_request
+        attach_y = float(attach_points[0].y) / size_request
+    elif info.get_filename():
+        # try read from the .icon file
+        icon_filename = info.get_filename().replace('.svg', '.icon')
+        if icon_filename != info.get_filename() and \
+            os.path.exists(icon_filename):
+
+            try:
+                with open(icon_filename) as config_file:
+                    cp = ConfigParser()
+                    cp.readfp(config_file)
+                    attach_points_str = cp.get('Icon Data', 'AttachPoints')
+                    attach_points = attach_points_str.split(',')
+                    attach_x = float(attach_points[0].strip()) / 1000
+                    attach_y = float(attach_points[1].strip()) / 1000
+            except Exception as e:
+                logging.exception('Exception reading icon info: %s', e)
+
+    return attach_x, attach_y
+
+
+class _IconThemeCache(object):
+    '''
+    Remembers how icon names resolve in the default icon theme, with
+    their attach points, so redraws do not probe the filesystem.  The
+    cache is cleared when the theme changes.
+    '''
+
+    def __init__(self):
+        self._cache = LRU(200)
+        self._theme = None
+
+    def _get_theme(self):
+        theme = Gtk.IconTheme.get_default()
+        if theme is not self._theme:
+            if self._theme is not None:
+                self._theme.disconnect_by_func(self.__theme_changed_cb)
+            theme.connect('changed', self.__theme_changed_cb)
+            self._theme = theme
+            self._cache = LRU(200)
+        return theme
+
+    def __theme_changed_cb(self, theme):
+        self._cache = LRU(200)
+
+    def lookup(self, icon_name, size):
+        '''
+        Returns:
+            tuple, (file_name, attach_x, attach_y), file_name is None if
+            the icon is not in the theme
+        '''
+        theme = self._get_theme()
+
+        key = (icon_name, size)
+        if key in self._cache:
+            return self._cache[key]
+
+        info = theme.lookup_icon(icon_name, size, 0)
+        if info:
+            attach_x, attach_y = _get_attach_points(info, size)
+            result = (info.get_filename(), attach_x, attach_y)
+            del info
+        else:
+            result = (None, 0, 0)
+
+        self._cache[key] = result
+        return result
+
+
+class _RenderThread(object):
+    '''
+    Renders icon buffers on a background thread.  The results are added
+    to the surface cache and handed to the callbacks from the main loop.
+
+    The keys of renderings that failed, or that are too large for the
+    surface cache, are remembered so that they are not queued again on
+    every draw.  Any change to the buffer properties changes the key.
+    '''
+
+    FAILED = 'failed'
+    UNCACHEABLE = 'uncacheable'
+
+    def __init__(self):
+        self._queue = Queue.Queue()
+        self._thread = None
+        self._callbacks = {}
+        self._failed_keys = LRU(100)
+
+    def get_failure(self, cache_key):
+        if cache_key not in self._failed_keys:
+            return None
+        return self._failed_keys[cache_key]
+
+    def render(self, icon_buffer, cache_key, theme_icons, callback):
+        if cache_key in self._callbacks:
+            self._callbacks[cache_key].append(callback)
+            return
+        self._callbacks[cache_key] = [callback]
+
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+        self._queue.put((icon_buffer, cache_key, theme_icons))
+
+    def _run(self):
+        while True:
+            icon_buffer, cache_key, theme_icons = self._queue.get()
+
+            def lookup(icon_name, size):
+                return theme_icons.get(icon_name, (None, 0, 0))
+
+            try:
+                with icon_buffer._render_lock:
+                    surface = icon_buffer._render(cache_key, lookup)
+            except Exception:
+                logging.exception('Error rendering icon %r', cache_key)
+                surface = None
+
+            GLib.idle_add(self.__rendered_cb, cache_key, surface)
+
+    def __rendered_cb(self, cache_key, surface):
+        if surface is None:
+            self._failed_keys[cache_key] = self.FAILED
+        else:
+            _IconBuffer._surface_cache[cache_key] = surface
+            if cache_key not in _IconBuffer._surface_cache:
+                self._failed_keys[cache_key] = self.UNCACHEABLE
+
+        for callback in self._callbacks.pop(cache_key, []):
+            callback(surface)
+
+        return False
+
+
+class _SurfaceRegion(object):
+    '''
+    The rectangle of a surface that holds one rendered icon, either a
+    whole surface or a cell of an atlas page.
+    '''
+
+    def __init__(self, surface, x=0, y=0, width=None, height=None):
+        self.surface = surface
+        self.x = x
+        self.y = y
+        if width is None:
+            width = surface.get_width()
+        if height is None:
+            height = surface.get_height()
+        self.width = width
+        self.height = height
+
+    def get_width(self):
+        return self.width
+
+    def get_height(self):
+        return self.height
+
+    def paint(self, cr, x, y, alpha=1.0):
+        cr.save()
+        cr.rectangle(x, y, self.width, self.height)
+        cr.clip()
+        cr.set_source_surface(self.surface, x - self.x, y - self.y)
+        if alpha == 1.0:
+            cr.paint()
+        else:
+            cr.paint_with_alpha(alpha)
+        cr.restore()
+
+
+class _AtlasPage(object):
+
+    def __init__(self, surface, columns, rows):
+        self.surface = surface
+        self.columns = columns
+        self.capacity = columns * rows
+        self.used = 0
+
+
+class _IconAtlas(object):
+    '''
+    Packs rendered icons of the same size and format into a few shared
+    page surfaces, laid out as a grid.  Pages are sized to demand: the
+    first one of a size holds a few icons, and each further one twice as
+    many, up to a full page.  Cells are never reused, the number of pages
+    per size and the bytes of all the pages are bounded instead, and icons
+    that do not fit keep their own surface.
+    '''
+
+    _PAGE_SIZE = 512
+    _FIRST_PAGE_CELLS = 4
+    _MAX_PAGES = 4
+
+    def __init__(self, max_size):
+        self.enabled = False
+        self.max_size = max_size
+        self.size = 0
+        self.page_count = 0
+        self._regions = {}
+        self._pages = {}
+
+    def lookup(self, cache_key):
+        return self._regions.get(cache_key)
+
+    def add(self, cache_key, surface):
+        width = surface.get_width()
+        height = surface.get_height()
+        columns = self._PAGE_SIZE // width
+        rows = self._PAGE_SIZE // height
+        if columns == 0 or rows == 0:
+            return None
+
+        surface_format = surface.get_format()
+        pages = self._pages.setdefault((width, height, surface_format), [])
+        if not pages or pages[-1].used == pages[-1].capacity:
+            if len(pages) == self._MAX_PAGES:
+                return None
+
+            cells = min(self._FIRST_PAGE_CELLS << len(pages), columns * rows)
+            page_columns = min(columns, cells)
+            page_rows = (cells + page_columns - 1) // page_columns
+            stride = cairo.ImageSurface.format_stride_for_width(
+                surface_format, page_columns * width)
+            page_size = stride * page_rows * height
+            if self.size + page_size > self.max_size:
+                return None
+
+            page_surface = cairo.ImageSurface(surface_format,
+                                              page_columns * width,
+                                              page_rows * height)
+            pages.append(_AtlasPage(page_surface, page_columns, page_rows))
+            self.size += page_size
+            self.page_count += 1
+
+        page = pages[-1]
+        x = (page.used % page.columns) * width
+        y = (page.used // page.columns) * height
+        page.used += 1
+
+        context = cairo.Context(page.surface)
+        context.set_operator(cairo.OPERATOR_SOURCE)
+        context.set_source_surface(surface, x, y)
+        context.rectangle(x, y, width, height)
+        context.fill()
+
+        region = _SurfaceRegion(page.surface, x, y, width, height)
+        self._regions[cache_key] = region
+        return region
 
 
 class _IconInfo(object):
@@ -156,8 +681,15 @@ class _BadgeInfo(object):
 
 class _IconBuffer(object):
 
-    _surface_cache = LRU(100)
+    _surface_cache = SizedLRU(_get_surface_cache_size(), _get_surface_size)
+    _disk_cache = _SurfaceDiskCache()
+    _theme_cache = _IconThemeCache()
     _loader = _SVGLoader()
+    _render_lock = threading.Lock()
+    _render_thread = _RenderThread()
+    # The atlas pages are counted against the budget of the surface cache
+    _cache_budget = _get_surface_cache_size()
+    _atlas = _IconAtlas(_cache_budget // 2)
 
     def __init__(self):
         self.icon_name = None
@@ -193,66 +725,31 @@ class _IconBuffer(object):
 
         return self._loader.load(file_name, entities, self.cache)
 
-    def _get_attach_points(self, info, size_request):
-        has_attach_points_, attach_points = info.get_attach_points()
-        attach_x = attach_y = 0
-        if attach_points:
-            # this works only for Gtk < 3.14
-            # https://developer.gnome.org/gtk3/stable/GtkIconTheme.html
-            # #gtk-icon-info-get-attach-points
-            attach_x = float(attach_points[0].x) / size_request
-            attach_y = float(attach_points[0].y) / size_request
-        elif info.get_filename():
-            # try read from the .icon file
-            icon_filename = info.get_filename().replace('.svg', '.icon')
-            if icon_filename != info.get_filename() and \
-                os.path.exists(icon_filename):
-
-                try:
-                    with open(icon_filename) as config_file:
-                        cp = ConfigParser()
-                        cp.readfp(config_file)
-                        attach_points_str = cp.get('Icon Data', 'AttachPoints')
-                        attach_points = attach_points_str.split(',')
-                        attach_x = float(attach_points[0].strip()) / 1000
-                        attach_y = float(attach_points[1].strip()) / 1000
-                except Exception as e:
-                    logging.exception('Exception reading icon info: %s', e)
-
-        return attach_x, attach_y
-
-    def _get_icon_info(self, file_name, icon_name):
+    def _get_icon_info(self, file_name, icon_name, lookup):
         icon_info = _IconInfo()
 
         if file_name:
             icon_info.file_name = file_name
         elif icon_name:
-            theme = Gtk.IconTheme.get_default()
-
             size = 50
             if self.width is not None:
                 size = self.width
 
-            info = theme.lookup_icon(icon_name, int(size), 0)
-            if info:
-                attach_x, attach_y = self._get_attach_points(info, size)
-
-                icon_info.file_name = info.get_filename()
+            file_name, attach_x, attach_y = lookup(icon_name, int(size))
+            if file_name:
+                icon_info.file_name = file_name
                 icon_info.attach_x = attach_x
                 icon_info.attach_y = attach_y
-
-                del info
             else:
                 logging.warning('No icon with the name %s was found in the '
                                 'theme.', icon_name)
 
         return icon_info
 
-    def _draw_badge(self, context, size, sensitive, widget):
-        theme = Gtk.IconTheme.get_default()
-        badge_info = theme.lookup_icon(self.badge_name, int(size), 0)
-        if badge_info:
-            badge_file_name = badge_info.get_filename()
+    def _draw_badge(self, context, size, lookup):
+        badge_file_name, attach_x_, attach_y_ = \
+            lookup(self.badge_name, int(size))
+        if badge_file_name:
             if badge_file_name.endswith('.svg'):
                 handle = self._loader.load(badge_file_name, {}, self.cache)
 
@@ -269,8 +766,6 @@ class _IconBuffer(object):
             context.scale(float(size) / icon_width,
                           float(size) / icon_height)
 
-            if not sensitive:
-                pixbuf = self._get_insensitive_pixbuf(pixbuf, widget)
             Gdk.cairo_set_source_pixbuf(context, pixbuf, 0, 0)
             context.paint()
 
@@ -317,37 +812,143 @@ class _IconBuffer(object):
             self.stroke_color = None
             self.fill_color = None
 
-    def _get_insensitive_pixbuf(self, pixbuf, widget):
-        if not (widget and widget.get_style()):
-            return pixbuf
+    def _resolve_theme_icons(self):
+        size = 50
+        if self.width is not None:
+            size = self.width
+
+        theme_icons = {}
+        for icon_name in (self.icon_name, 'document-generic'):
+            if icon_name:
+                theme_icons[icon_name] = \
+                    self._theme_cache.lookup(icon_name, int(size))
+        if self.badge_name:
+            theme_icons[self.badge_name] = self._theme_cache.lookup(
+                self.badge_name, int(_BADGE_SIZE * size))
+
+        return theme_icons
 
-        icon_source = Gtk.IconSource()
-        # Special size meaning "don't touch"
-        icon_source.set_size(-1)
-        icon_source.set_pixbuf(pixbuf)
-        icon_source.set_state(Gtk.StateType.INSENSITIVE)
-        icon_source.set_direction_wildcarded(False)
-        icon_source.set_size_wildcarded(False)
+    def _get_background_free_buffer(self):
+        if self.background_color is None:
+            return self
 
-        widget_style = widget.get_style()
-        pixbuf = widget_style.render_icon(
-            icon_source, widget.get_direction(),
-            Gtk.StateType.INSENSITIVE, -1, widget,
-            'sugar-icon')
+        icon_buffer = copy.copy(self)
+        icon_buffer.background_color = None
+        return icon_buffer
 
-        return pixbuf
+    def _cache_insensitive_surface(self, cache_key, surface):
+        surface = _create_insensitive_surface(surface, self.background_color)
+        self._surface_cache[cache_key] = surface
+        return surface
 
     def get_surface(self, sensitive=True, widget=None):
         cache_key = self._get_cache_key(sensitive)
+        surface = self._surface_cache.get(cache_key)
+        if surface is not None:
+            return surface
+
+        if not sensitive:
+            # Insensitive icons are derived from the sensitive rendering,
+            # drawn without background so that only the icon is faded
+            icon_buffer = self._get_background_free_buffer()
+            surface = icon_buffer.get_surface(True, widget)
+            if surface is None:
+                return None
+            return self._cache_insensitive_surface(cache_key, surface)
+
+        with self._render_lock:
+            surface = self._render(cache_key, self._theme_cache.lookup)
+
+        if surface is not None:
+            self._surface_cache[cache_key] = surface
+
+        return surface
+
+    def get_region(self, sensitive=True, widget=None):
+        '''
+        Like get_surface, but returns a _SurfaceRegion, that is a cell of
+        the icon atlas when the atlas mode is enabled.
+        '''
+        if not self._atlas.enabled:
+            surface = self.get_surface(sensitive, widget)
+            if surface is None:
+                return None
+            return _SurfaceRegion(surface)
+
+        cache_key = self._get_cache_key(sensitive)
+        region = self._atlas.lookup(cache_key)
+        if region is not None:
+            return region
+
+        surface = self.get_surface(sensitive, widget)
+        if surface is None:
+            return None
+
+        atlas_size = self._atlas.size
+        region = self._atlas.add(cache_key, surface)
+        if self._atlas.size != atlas_size:
+            _update_cache_budget()
+        if region is None:
+            return _SurfaceRegion(surface)
+
+        # The atlas holds the pixels from now on
         if cache_key in self._surface_cache:
-            return self._surface_cache[cache_key]
+            del self._surface_cache[cache_key]
+
+        return region
+
+    def get_cached_surface(self, sensitive=True):
+        '''
+        Returns:
+            the surface if it is already in the icon cache, otherwise None
+        '''
+        return self._surface_cache.get(self._get_cache_key(sensitive))
+
+    def get_surface_async(self, sensitive, widget, callback):
+        '''
+        Like get_surface, but a surface that is not cached yet is rendered
+        on a background thread.  In that case None is returned, and
+        callback(surface) is called from the main loop when it is ready.
+        '''
+        cache_key = self._get_cache_key(sensitive)
+        surface = self._surface_cache.get(cache_key)
+        if surface is not None:
+            return surface
+
+        if not sensitive:
+            icon_buffer = self._get_background_free_buffer()
+            surface = icon_buffer.get_surface_async(True, widget, callback)
+            if surface is None:
+                return None
+            return self._cache_insensitive_surface(cache_key, surface)
+
+        failure = self._render_thread.get_failure(cache_key)
+        if failure == _RenderThread.FAILED:
+            return None
+        elif failure == _RenderThread.UNCACHEABLE:
+            return self.get_surface(sensitive, widget)
+
+        # The icon theme is not thread safe, so the theme lookups are
+        # done here and the background thread renders a snapshot
+        self._render_thread.render(copy.copy(self), cache_key,
+                                   self._resolve_theme_icons(), callback)
+        return None
+
+    def _render(self, cache_key, lookup):
+        # Only renderings of icon files go to the disk cache, not the
+        # ones of pixbufs set on the buffer, and not the XoColor variants,
+        # which are too many to be worth keeping
+        disk_file_name = None
+        use_disk_cache = self.fill_color is None and \
+            self.stroke_color is None
 
         if self.pixbuf:
             # We alredy have the pixbuf for this icon.
             pixbuf = self.pixbuf
             icon_width = pixbuf.get_width()
             icon_height = pixbuf.get_height()
-            icon_info = self._get_icon_info(self.file_name, self.icon_name)
+            icon_info = self._get_icon_info(self.file_name, self.icon_name,
+                                            lookup)
             is_svg = False
         else:
             # We run two attempts at finding the icon. First, we try the icon
@@ -356,10 +957,17 @@ class _IconBuffer(object):
             icon_width = None
             for (file_name, icon_name) in ((self.file_name, self.icon_name),
                                            (None, 'document-generic')):
-                icon_info = self._get_icon_info(file_name, icon_name)
+                icon_info = self._get_icon_info(file_name, icon_name, lookup)
                 if icon_info.file_name is None:
                     return None
 
+                if use_disk_cache:
+                    surface = self._disk_cache.load(cache_key,
+                                                    icon_info.file_name)
+                    if surface is not None:
+                        return surface
+                    disk_file_name = icon_info.file_name
+
                 is_svg = icon_info.file_name.endswith('.svg')
 
                 if is_svg:
@@ -405,26 +1013,18 @@ class _IconBuffer(object):
 
         context.translate(padding, padding)
         if is_svg:
-            if sensitive:
-                handle.render_cairo(context)
-            else:
-                pixbuf = handle.get_pixbuf()
-                pixbuf = self._get_insensitive_pixbuf(pixbuf, widget)
-
-                Gdk.cairo_set_source_pixbuf(context, pixbuf, 0, 0)
-                context.paint()
+            handle.render_cairo(context)
         else:
-            if not sensitive:
-                pixbuf = self._get_insensitive_pixbuf(pixbuf, widget)
             Gdk.cairo_set_source_pixbuf(context, pixbuf, 0, 0)
             context.paint()
 
         if self.badge_name:
             context.restore()
             context.translate(badge_info.attach_x, badge_info.attach_y)
-            self._draw_badge(context, badge_info.size, sensitive, widget)
+            self._draw_badge(context, badge_info.size, lookup)
 
-        self._surface_cache[cache_key] = surface
+        if disk_file_name is not None:
+            self._disk_cache.store(cache_key, disk_file_name, surface)
 
         return surface
 
@@ -465,6 +1065,8 @@ class Icon(Gtk.Image):
         badge_name (str): the icon_name for a badge icon,
             see :any:`set_badge_name`
         alpha (float): transparency of the icon, defaults to 1.0
+        async_render (bool): render the icon on a background thread,
+            see :any:`set_async_render`
     '''
 
     __gtype_name__ = 'SugarIcon'
@@ -481,6 +1083,8 @@ class Icon(Gtk.Image):
         self._file = None
         self._alpha = 1.0
         self._scale = 1.0
+        self._async_render = False
+        self._last_region = None
 
         # FIXME: deprecate icon_size
         if 'icon_size' in kwargs:
@@ -547,6 +1151,22 @@ class Icon(Gtk.Image):
             self._buffer.width = width
             self._buffer.height = height
 
+    def _get_region(self, sensitive=True):
+        if not self._async_render:
+            return self._buffer.get_region(sensitive, self)
+
+        surface = self._buffer.get_surface_async(
+            sensitive, self, self.__surface_rendered_cb)
+        if surface is None:
+            return self._last_region
+
+        self._last_region = _SurfaceRegion(surface)
+        return self._last_region
+
+    def __surface_rendered_cb(self, surface):
+        if surface is not None:
+            self.queue_resize()
+
     def _icon_size_changed_cb(self, image, pspec):
         self._buffer.icon_size = self.props.icon_size
 
@@ -559,9 +1179,9 @@ class Icon(Gtk.Image):
     def do_get_preferred_height(self):
         '''Gtk widget implementation method'''
         self._sync_image_properties()
-        surface = self._buffer.get_surface()
-        if surface:
-            height = surface.get_height()
+        region = self._get_region()
+        if region:
+            height = region.get_height()
         elif self._buffer.height:
             height = self._buffer.height
         else:
@@ -571,9 +1191,9 @@ class Icon(Gtk.Image):
     def do_get_preferred_width(self):
         '''Gtk widget implementation method'''
         self._sync_image_properties()
-        surface = self._buffer.get_surface()
-        if surface:
-            width = surface.get_width()
+        region = self._get_region()
+        if region:
+            width = region.get_width()
         elif self._buffer.width:
             width = self._buffer.width
         else:
@@ -584,8 +1204,8 @@ class Icon(Gtk.Image):
         '''Gtk widget implementation method'''
         self._sync_image_properties()
         sensitive = (self.is_sensitive())
-        surface = self._buffer.get_surface(sensitive, self)
-        if surface is None:
+        region = self._get_region(sensitive)
+        if region is None:
             return
 
         xpad, ypad = self.get_padding()
@@ -609,12 +1229,7 @@ class Icon(Gtk.Image):
             x = x / self._scale
             y = y / self._scale
 
-        cr.set_source_surface(surface, x, y)
-
-        if self._alpha == 1.0:
-            cr.paint()
-        else:
-            cr.paint_with_alpha(self._alpha)
+        region.paint(cr, x, y, self._alpha)
 
     def set_xo_color(self, value):
         '''
@@ -758,6 +1373,32 @@ class Icon(Gtk.Image):
     icon.props.scale -> see :any:`set_scale`, note no getter
     '''
 
+    def set_async_render(self, value):
+        '''
+        Render the icon on a background thread when it is not in the icon
+        cache, instead of blocking the draw.  Until the rendering is done,
+        the previous surface of the icon is drawn, if there is one.
+
+        Args:
+            value (bool): if True, render in the background
+        '''
+        self._async_render = value
+
+    def get_async_render(self):
+        '''
+        Returns:
+            bool, if the icon is rendered in the background
+        '''
+        return self._async_render
+
+    async_render = GObject.property(
+        type=bool, default=False, getter=get_async_render,
+        setter=set_async_render)
+    '''
+    icon.props.async_render -> see :any:`set_async_render`
+        and :any:`get_async_render`
+    '''
+
 
 class EventIcon(Gtk.EventBox):
     '''
@@ -814,24 +1455,20 @@ class EventIcon(Gtk.EventBox):
 
     def do_draw(self, cr):
         '''Gtk widget implementation method'''
-        surface = self._buffer.get_surface()
-        if surface:
+        region = self._buffer.get_region()
+        if region:
             allocation = self.get_allocation()
 
-            x = (allocation.width - surface.get_width()) / 2
-            y = (allocation.height - surface.get_height()) / 2
+            x = (allocation.width - region.get_width()) / 2
+            y = (allocation.height - region.get_height()) / 2
 
-            cr.set_source_surface(surface, x, y)
-            if self._alpha == 1.0:
-                cr.paint()
-            else:
-                cr.paint_with_alpha(self._alpha)
+            region.paint(cr, x, y, self._alpha)
 
     def do_get_preferred_height(self):
         '''Gtk widget implementation method'''
-        surface = self._buffer.get_surface()
-        if surface:
-            height = surface.get_height()
+        region = self._buffer.get_region()
+        if region:
+            height = region.get_height()
         elif self._buffer.height:
             height = self._buffer.height
         else:
@@ -840,9 +1477,9 @@ class EventIcon(Gtk.EventBox):
 
     def do_get_preferred_width(self):
         '''Gtk widget implementation method'''
-        surface = self._buffer.get_surface()
-        if surface:
-            width = surface.get_width()
+        region = self._buffer.get_region()
+        if region:
+            width = region.get_width()
         elif self._buffer.width:
             width = self._buffer.width
         else:
@@ -1177,20 +1814,66 @@ class CellRendererIcon(Gtk.CellRenderer):
         self._prelit_stroke_color = None
         self._active_state = False
         self._cached_offsets = None
+        self._async_render = False
 
         Gtk.CellRenderer.__init__(self)
 
         self._is_scrolling = False
+        self._deferred = {}
+        self._deferred_widget = None
+        self._deferred_job_id = None
 
     def connect_to_scroller(self, scrolled):
+        '''
+        Connect to a ScrollingDetector.  While scrolling, only the icons
+        already in the icon cache are drawn.  The others are rendered
+        when scrolling ends, the most visible rows first.
+
+        Args:
+            scrolled (sugar3.graphics.scrollingdetector.ScrollingDetector):
+                detector of the scrolled window holding the tree view
+        '''
         scrolled.connect('scroll-start', self._scroll_start_cb)
         scrolled.connect('scroll-end', self._scroll_end_cb)
 
     def _scroll_start_cb(self, event):
         self._is_scrolling = True
+        if self._deferred_job_id is not None:
+            GLib.source_remove(self._deferred_job_id)
+            self._deferred_job_id = None
 
     def _scroll_end_cb(self, event):
         self._is_scrolling = False
+        self._render_deferred()
+
+    def _defer_render(self, widget, cell_area):
+        height = widget.get_allocated_height()
+        visible = min(cell_area.y + cell_area.height, height) - \
+            max(cell_area.y, 0)
+
+        cache_key = self._buffer._get_cache_key(True)
+        self._deferred[cache_key] = ((-visible, cell_area.y),
+                                     copy.copy(self._buffer))
+        self._deferred_widget = widget
+
+    def _render_deferred(self):
+        if not self._deferred:
+            return
+
+        buffers = [icon_buffer for order_, icon_buffer in
+                   sorted(self._deferred.values(), key=lambda x: x[0])]
+        widget = self._deferred_widget
+        self._deferred = {}
+        self._deferred_widget = None
+
+        def progress_cb(done, total):
+            widget.queue_draw()
+            if done == total:
+                self._deferred_job_id = None
+
+        job = _PrerenderJob(buffers, progress_cb, 4,
+                            create_buffer=lambda icon_buffer: icon_buffer)
+        self._deferred_job_id = job.start()
 
     def is_scrolling(self):
         return self._is_scrolling
@@ -1261,6 +1944,16 @@ class CellRendererIcon(Gtk.CellRenderer):
 
     size = GObject.property(type=object, setter=set_size)
 
+    def set_async_render(self, value):
+        self._async_render = value
+
+    def get_async_render(self):
+        return self._async_render
+
+    async_render = GObject.property(type=bool, default=False,
+                                    getter=get_async_render,
+                                    setter=set_async_render)
+
     def do_get_size(self, widget, cell_area, x_offset=None, y_offset=None,
                     width=None, height=None):
         width = self._buffer.width + self.props.xpad * 2
@@ -1357,7 +2050,15 @@ class CellRendererIcon(Gtk.CellRenderer):
                 self._buffer.fill_color = self._fill_color
                 self._buffer.stroke_color = self._stroke_color
 
-        surface = self._buffer.get_surface()
+        if self._is_scrolling:
+            surface = self._buffer.get_cached_surface()
+            if surface is None:
+                self._defer_render(widget, cell_area)
+        elif self._async_render:
+            surface = self._buffer.get_surface_async(
+                True, widget, partial(self.__surface_rendered_cb, widget))
+        else:
+            surface = self._buffer.get_surface()
         if surface is None:
             return
 
@@ -1372,6 +2073,10 @@ class CellRendererIcon(Gtk.CellRenderer):
         cr.clip()
         cr.paint()
 
+    def __surface_rendered_cb(self, widget, surface):
+        if surface is not None:
+            widget.queue_draw()
+
 
 def get_icon_state(base_name, perc, step=5):
     '''
@@ -1437,6 +2142,76 @@ def get_icon_file_name(icon_name):
     return filename
 
 
+def set_icon_cache_size(size):
+    '''
+    Set the memory budget of the rendered icon cache.  The default is
+    4 MiB, and can also be set through the SUGAR_ICON_CACHE_SIZE
+    environment variable.  Every surface counts as width * height * 4
+    bytes.  The pages of the icon atlas, when enabled, may take up to
+    half of it.
+
+    Args:
+        size (int): budget in bytes
+    '''
+    _IconBuffer._cache_budget = size
+    _update_cache_budget()
+
+
+def _update_cache_budget():
+    budget = _IconBuffer._cache_budget
+    atlas = _IconBuffer._atlas
+    atlas.max_size = budget // 2
+    _IconBuffer._surface_cache.set_max_size(max(0, budget - atlas.size))
+
+
+def set_atlas_mode(enabled):
+    '''
+    Draw :class:`Icon` and :class:`EventIcon` widgets from a shared icon
+    atlas, where rendered icons of the same size are packed into a few
+    large surfaces.  This saves a surface per icon for toolbars and trays
+    with many icons.  It should be enabled before the widgets are drawn.
+
+    Args:
+        enabled (bool): if True, use the icon atlas
+    '''
+    _IconBuffer._atlas.enabled = enabled
+
+
+def get_icon_cache_stats():
+    '''
+    Get statistics about the icon caches of this process.
+
+    Returns:
+        dict, with the `hits`, `misses` and `evictions` counters of the
+        rendered icon cache, its `resident_bytes`, `max_bytes` and number
+        of `entries`, the `atlas_bytes` and `atlas_pages` of the icon
+        atlas, which are taken from the same budget, plus the
+        `handle_hits` and `handle_misses` counters and the number of
+        `handles` held by the parsed SVG handle cache
+    '''
+    surface_stats = _IconBuffer._surface_cache.get_stats()
+    stats = {'hits': surface_stats['hits'],
+             'misses': surface_stats['misses'],
+             'evictions': surface_stats['evictions'],
+             'resident_bytes': surface_stats['size'],
+             'max_bytes': surface_stats['max_size'],
+             'entries': surface_stats['entries'],
+             'atlas_bytes': _IconBuffer._atlas.size,
+             'atlas_pages': _IconBuffer._atlas.page_count}
+    stats.update(_IconBuffer._loader.get_stats())
+    return stats
+
+
+def _create_buffer(kwargs):
+    icon = _IconBuffer()
+    for key, value in kwargs.items():
+        if key == 'pixel_size':
+            icon.width = icon.height = value
+        else:
+            icon.__setattr__(key, value)
+    return icon
+
+
 def get_surface(**kwargs):
     '''
     Get cairo surface of the icon.  Supports the same arguments as
@@ -1445,7 +2220,56 @@ def get_surface(**kwargs):
     Returns:
         cairo surface or None if image was not found
     '''
-    icon = _IconBuffer()
-    for key, value in kwargs.items():
-        icon.__setattr__(key, value)
-    return icon.get_surface()
+    return _create_buffer(kwargs).get_surface()
+
+
+class _PrerenderJob(object):
+
+    def __init__(self, specs, progress_cb, batch_size,
+                 create_buffer=_create_buffer):
+        self._specs = list(specs)
+        self._progress_cb = progress_cb
+        self._batch_size = max(batch_size, 1)
+        self._create_buffer = create_buffer
+        self._done = 0
+
+    def start(self):
+        return GLib.idle_add(self.__idle_cb, priority=GLib.PRIORITY_LOW)
+
+    def __idle_cb(self):
+        batch = self._specs[self._done:self._done + self._batch_size]
+        for spec in batch:
+            try:
+                self._create_buffer(spec).get_surface()
+            except Exception:
+                logging.exception('Error prerendering icon %r', spec)
+        self._done += len(batch)
+
+        if self._progress_cb is not None:
+            self._progress_cb(self._done, len(self._specs))
+
+        return self._done < len(self._specs)
+
+
+def prerender(specs, progress_cb=None, batch_size=4):
+    '''
+    Render icons into the icon cache ahead of their first draw, for
+    example while the activity is starting.  The icons are rendered in
+    small batches from a low priority idle handler, so the main loop
+    stays responsive.
+
+    Args:
+        specs (list): dictionaries with the keyword arguments accepted by
+            :any:`get_surface`, eg. `{'icon_name': 'computer-xo',
+            'xo_color': color, 'pixel_size': style.STANDARD_ICON_SIZE}`
+
+    Keyword Args:
+        progress_cb (callable): called as `progress_cb(done, total)`
+            after every batch
+        batch_size (int): number of icons rendered per idle callback
+
+    Returns:
+        int, the idle source id, that can be passed to
+        `GLib.source_remove` to cancel the job
+    '''
+    return _PrerenderJob(specs, progress_cb, batch_size).start()
@@ -20,7 +20,7 @@ STABLE.
 """
 
 import logging
-import StringIO
+from hashlib import sha1
 import cairo
 
 from gi.repository import GObject
@@ -29,7 +29,9 @@ from gi.repository import Gdk
 import dbus
 
 from sugar3.datastore import datastore
+from sugar3.graphics.preview import decode_preview
 from sugar3.activity.activity import PREVIEW_SIZE
+from sugar3.util import SizedLRU
 
 
 J_DBUS_SERVICE = 'org.laptop.Journal'
@@ -40,6 +42,24 @@ FILTER_TYPE_MIME_BY_ACTIVITY = 'mime_by_activity'
 FILTER_TYPE_GENERIC_MIME = 'generic_mime'
 FILTER_TYPE_ACTIVITY = 'activity'
 
+# Decoded previews, keyed by (digest of the data, width, height)
+_preview_cache = SizedLRU(
+    8 * 1024 * 1024,
+    get_size=lambda pixbuf: pixbuf.get_rowstride() * pixbuf.get_height())
+
+
+def get_preview_cache_stats():
+    """
+    Get statistics about the cache of decoded previews used by
+    get_preview_pixbuf().
+
+    Returns:
+        dict, with the `hits`, `misses` and `evictions` counters, the
+        `size` in bytes of the cached pixbufs, the `max_size` budget and
+        the number of `entries`
+    """
+    return _preview_cache.get_stats()
+
 
 def get_preview_pixbuf(preview_data, width=-1, height=-1):
     """
@@ -55,7 +75,8 @@ def get_preview_pixbuf(preview_data, width=-1, height=-1):
         height (int): the pixbuf width, if is not set, the default height will be used
 
     Returns:
-        Pixbuf, the generated Pixbuf
+        Pixbuf, the generated Pixbuf, which may be shared with other
+            callers and must not be modified
         None, if it could not be created
 
     Example:
@@ -77,15 +98,14 @@ def get_preview_pixbuf(preview_data, width=-1, height=-1):
     pixbuf = None
 
     if len(preview_data) > 4:
-        if preview_data[1:4] != 'PNG':
-            # TODO: We are close to be able to drop this.
-            import base64
-            preview_data = base64.b64decode(preview_data)
+        key = (sha1(preview_data).digest(), width, height)
+        pixbuf = _preview_cache.get(key)
+        if pixbuf is not None:
+            return pixbuf
 
-        png_file = StringIO.StringIO(preview_data)
         try:
             # Load image and scale to dimensions
-            surface = cairo.ImageSurface.create_from_png(png_file)
+            surface = decode_preview(preview_data)
             png_width = surface.get_width()
             png_height = surface.get_height()
 
@@ -107,6 +127,7 @@ def get_preview_pixbuf(preview_data, width=-1, height=-1):
 
             pixbuf = Gdk.pixbuf_get_from_surface(preview_surface, 0, 0,
                                                  width, height)
+            _preview_cache[key] = pixbuf
         except Exception:
             logging.exception('Error while loading the preview')
 
@@ -0,0 +1,169 @@
+# Copyright (C) 2026, Sugar Labs
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+"""
+Encoding and decoding of the preview images stored in the journal
+metadata.
+
+Previews can be stored as PNG, the default, as JPEG, or as raw
+premultiplied ARGB32 pixels behind a small header, which is the cheapest
+to write and to read back.  decode_preview() detects the format from the
+data itself.
+
+UNSTABLE.
+"""
+
+import base64
+import struct
+import StringIO
+
+import cairo
+from gi.repository import Gdk
+from gi.repository import GdkPixbuf
+
+PREVIEW_FORMAT_PNG = 'png'
+PREVIEW_FORMAT_JPEG = 'jpeg'
+PREVIEW_FORMAT_RAW = 'raw'
+
+_RAW_MAGIC = 'SPV1'
+_RAW_HEADER = '<4sii'
+_RAW_HEADER_SIZE = struct.calcsize(_RAW_HEADER)
+
+_PNG_MAGIC = '\x89PNG'
+_JPEG_MAGIC = '\xff\xd8\xff'
+
+
+def _save_pixbuf(surface, pixbuf_type, options):
+    pixbuf = Gdk.pixbuf_get_from_surface(surface, 0, 0, surface.get_width(),
+                                         surface.get_height())
+    keys = options.keys()
+    values = [str(options[key]) for key in keys]
+    success, data = pixbuf.save_to_bufferv(pixbuf_type, keys, values)
+    if not success:
+        raise ValueError('Could not encode the preview as %s' % pixbuf_type)
+    return data
+
+
+def _encode_png(surface, compression=None):
+    if compression is None:
+        preview_str = StringIO.StringIO()
+        surface.write_to_png(preview_str)
+        return preview_str.getvalue()
+
+    return _save_pixbuf(surface, 'png', {'compression': compression})
+
+
+def _encode_jpeg(surface, quality=90):
+    # JPEG has no alpha, and transparent pixels would turn black, so
+    # flatten the image onto white first
+    opaque_surface = cairo.ImageSurface(cairo.FORMAT_RGB24,
+                                        surface.get_width(),
+                                        surface.get_height())
+    cr = cairo.Context(opaque_surface)
+    cr.set_source_rgb(1, 1, 1)
+    cr.paint()
+    cr.set_source_surface(surface)
+    cr.paint()
+    del cr
+
+    return _save_pixbuf(opaque_surface, 'jpeg', {'quality': quality})
+
+
+def _encode_raw(surface):
+    surface.flush()
+    header = struct.pack(_RAW_HEADER, _RAW_MAGIC, surface.get_width(),
+                         surface.get_height())
+    return header + str(surface.get_data())
+
+
+_encoders = {
+    PREVIEW_FORMAT_PNG: _encode_png,
+    PREVIEW_FORMAT_JPEG: _encode_jpeg,
+    PREVIEW_FORMAT_RAW: _encode_raw,
+}
+
+
+def encode_preview(surface, preview_format=PREVIEW_FORMAT_PNG, **options):
+    """
+    Encode an ARGB32 image surface as preview data.
+
+    Args:
+        surface (cairo.ImageSurface): the preview image
+        preview_format (str): one of PREVIEW_FORMAT_PNG, PREVIEW_FORMAT_JPEG
+            or PREVIEW_FORMAT_RAW
+
+    Keyword Args:
+        compression (int): zlib compression level, 0 to 9, for PNG
+        quality (int): quality, 0 to 100, for JPEG
+
+    Returns:
+        str, the encoded data
+    """
+    if preview_format not in _encoders:
+        raise ValueError('Unknown preview format %r' % preview_format)
+    return _encoders[preview_format](surface, **options)
+
+
+def _load_pixbuf(data):
+    loader = GdkPixbuf.PixbufLoader()
+    loader.write(data)
+    loader.close()
+    pixbuf = loader.get_pixbuf()
+
+    surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, pixbuf.get_width(),
+                                 pixbuf.get_height())
+    cr = cairo.Context(surface)
+    Gdk.cairo_set_source_pixbuf(cr, pixbuf, 0, 0)
+    cr.paint()
+    return surface
+
+
+def _decode_raw(data):
+    magic_, width, height = struct.unpack(_RAW_HEADER,
+                                          data[:_RAW_HEADER_SIZE])
+    stride = cairo.ImageSurface.format_stride_for_width(cairo.FORMAT_ARGB32,
+                                                        width)
+    pixels = bytearray(data[_RAW_HEADER_SIZE:])
+    if len(pixels) < stride * height:
+        raise ValueError('Truncated raw preview')
+    return cairo.ImageSurface.create_for_data(pixels, cairo.FORMAT_ARGB32,
+                                              width, height, stride)
+
+
+def decode_preview(data):
+    """
+    Decode preview data in any of the supported formats.
+
+    Previews stored base64 encoded by old versions are still accepted.
+
+    Args:
+        data (str): the preview data from the metadata
+
+    Returns:
+        cairo.ImageSurface, the preview image
+    """
+    data = str(data)
+    if not data.startswith((_RAW_MAGIC, _PNG_MAGIC, _JPEG_MAGIC)):
+        # TODO: We are close to be able to drop this.
+        data = base64.b64decode(data)
+
+    if data.startswith(_RAW_MAGIC):
+        return _decode_raw(data)
+    elif data.startswith(_PNG_MAGIC):
+        return cairo.ImageSurface.create_from_png(StringIO.StringIO(data))
+    else:
+        return _load_pixbuf(data)
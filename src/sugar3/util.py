@@ -29,6 +29,7 @@ import gettext
 import tempfile
 import logging
 import atexit
+import collections
 
 
 _ = lambda msg: gettext.dgettext('sugar-toolkit-gtk3', msg)
@@ -143,6 +144,9 @@ class LRU:
     def __contains__(self, obj):
         return obj in self.d
 
+    def __len__(self):
+        return len(self.d)
+
     def __getitem__(self, obj):
         a = self.d[obj].me
         self[a[0]] = a[1]
@@ -207,6 +211,95 @@ class LRU:
         return self.d.keys()
 
 
+class SizedLRU(object):
+    """
+    A LRU cache bounded by the total size of its values instead of by
+    the number of entries.  Values larger than the whole budget are not
+    stored.
+
+    Args:
+        max_size (int): size budget, in the unit returned by `get_size`
+        get_size (callable): returns the size of a value, defaults to len
+    """
+
+    def __init__(self, max_size, get_size=len):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._get_size = get_size
+        self._items = collections.OrderedDict()
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def __getitem__(self, key):
+        value = self.get(key, self)
+        if value is self:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        if key in self._items:
+            del self[key]
+
+        size = self._get_size(value)
+        if size > self.max_size:
+            return
+
+        self._items[key] = (value, size)
+        self.size += size
+        self._shrink()
+
+    def __delitem__(self, key):
+        value_, size = self._items.pop(key)
+        self.size -= size
+
+    def get(self, key, default=None):
+        """Get the value for key, marking it as recently used"""
+        try:
+            item = self._items.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+
+        self._items[key] = item
+        self.hits += 1
+        return item[0]
+
+    def set_max_size(self, max_size):
+        """Change the size budget, evicting entries if needed"""
+        self.max_size = max_size
+        self._shrink()
+
+    def clear(self):
+        self._items.clear()
+        self.size = 0
+
+    def get_stats(self):
+        """
+        Returns:
+            dict, with the hits, misses and evictions counters, and the
+            current size, budget and number of entries
+        """
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': self.size,
+                'max_size': self.max_size,
+                'entries': len(self._items)}
+
+    def _shrink(self):
+        while self.size > self.max_size and self._items:
+            key_, (value_, size) = self._items.popitem(last=False)
+            self.size -= size
+            self.evictions += 1
+
+
 units = [['%d year', '%d years', 356 * 24 * 60 * 60],
          ['%d month', '%d months', 30 * 24 * 60 * 60],
          ['%d week', '%d weeks', 7 * 24 * 60 * 60],
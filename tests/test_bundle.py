@@ -14,10 +14,14 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
+import io
 import os
+import tempfile
 import unittest
 import subprocess
+import zipfile
 
+from sugar3.bundle.bundle import open_zip_member
 from sugar3.bundle.helpers import bundle_from_dir, bundle_from_archive
 from sugar3.bundle.activitybundle import ActivityBundle
 from sugar3.bundle.contentbundle import ContentBundle
@@ -47,3 +51,27 @@ class TestBundle(unittest.TestCase):
         subprocess.check_call(["zip", "-r", "sample-1.xol", "sample.content"])
         bundle = bundle_from_archive("./sample-1.xol")
         self.assertIsInstance(bundle, ContentBundle)
+
+    def test_open_zip_member(self):
+        fd, zip_path = tempfile.mkstemp(suffix='.zip')
+        os.close(fd)
+        self.addCleanup(os.remove, zip_path)
+
+        zip_file = zipfile.ZipFile(zip_path, 'w')
+        zip_file.writestr(zipfile.ZipInfo('sample/stored'), '0123456789')
+        zip_file.writestr('sample/deflated', 'x' * 1000, zipfile.ZIP_DEFLATED)
+        zip_file.close()
+
+        archive = io.open(zip_path, 'rb')
+        stream = open_zip_member(archive, 'sample/stored')
+        self.assertEqual(stream.read(3), '012')
+        stream.seek(-2, io.SEEK_END)
+        self.assertEqual(stream.read(), '89')
+        stream.close()
+        self.assertTrue(archive.closed)
+
+        archive = io.open(zip_path, 'rb')
+        stream = open_zip_member(archive, 'sample/deflated')
+        self.assertEqual(stream.read(), 'x' * 1000)
+        stream.close()
+        self.assertTrue(archive.closed)
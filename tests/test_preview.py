@@ -0,0 +1,68 @@
+# Copyright (C) 2026, Sugar Labs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import base64
+import unittest
+
+import cairo
+
+from sugar3.graphics.preview import encode_preview, decode_preview
+from sugar3.graphics.preview import PREVIEW_FORMAT_PNG, \
+    PREVIEW_FORMAT_JPEG, PREVIEW_FORMAT_RAW
+
+
+def _create_surface(width=30, height=20):
+    surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+    cr = cairo.Context(surface)
+    cr.set_source_rgba(1, 0, 0, 0.5)
+    cr.rectangle(0, 0, width / 2, height)
+    cr.fill()
+    del cr
+    return surface
+
+
+class TestPreview(unittest.TestCase):
+    def _assert_round_trip(self, preview_format, **options):
+        data = encode_preview(_create_surface(), preview_format, **options)
+        surface = decode_preview(data)
+        self.assertEqual(surface.get_width(), 30)
+        self.assertEqual(surface.get_height(), 20)
+
+    def test_png(self):
+        self._assert_round_trip(PREVIEW_FORMAT_PNG)
+
+    def test_png_compression(self):
+        self._assert_round_trip(PREVIEW_FORMAT_PNG, compression=1)
+
+    def test_jpeg(self):
+        self._assert_round_trip(PREVIEW_FORMAT_JPEG, quality=50)
+
+    def test_raw(self):
+        self._assert_round_trip(PREVIEW_FORMAT_RAW)
+
+    def test_base64_png(self):
+        data = encode_preview(_create_surface(), PREVIEW_FORMAT_PNG)
+        surface = decode_preview(base64.b64encode(data))
+        self.assertEqual(surface.get_width(), 30)
+        self.assertEqual(surface.get_height(), 20)
+
+    def test_truncated_raw(self):
+        data = encode_preview(_create_surface(), PREVIEW_FORMAT_RAW)
+        self.assertRaises(ValueError, decode_preview, data[:-1])
+
+    def test_unknown_format(self):
+        self.assertRaises(ValueError, encode_preview, _create_surface(),
+                          'bmp')
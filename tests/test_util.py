@@ -0,0 +1,69 @@
+# Copyright (C) 2026, Sugar Labs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import unittest
+
+from sugar3.util import SizedLRU
+
+
+class TestSizedLRU(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        cache = SizedLRU(10)
+        cache['a'] = 'xxxx'
+        cache['b'] = 'xxxx'
+        self.assertEqual(cache['a'], 'xxxx')
+
+        cache['c'] = 'xxxx'
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.assertIn('c', cache)
+        self.assertEqual(cache.size, 8)
+        self.assertEqual(cache.evictions, 1)
+
+    def test_skips_values_larger_than_budget(self):
+        cache = SizedLRU(4)
+        cache['a'] = 'xxxxx'
+        self.assertNotIn('a', cache)
+        self.assertEqual(cache.size, 0)
+
+    def test_replace_updates_size(self):
+        cache = SizedLRU(10)
+        cache['a'] = 'xxxx'
+        cache['a'] = 'xx'
+        self.assertEqual(cache.size, 2)
+        self.assertEqual(len(cache), 1)
+
+    def test_set_max_size(self):
+        cache = SizedLRU(10)
+        cache['a'] = 'xxxx'
+        cache['b'] = 'xxxx'
+        cache.set_max_size(5)
+        self.assertNotIn('a', cache)
+        self.assertIn('b', cache)
+
+    def test_stats(self):
+        cache = SizedLRU(10, get_size=lambda value: value)
+        cache['a'] = 3
+        cache.get('a')
+        cache.get('b')
+        self.assertRaises(KeyError, lambda: cache['b'])
+
+        stats = cache.get_stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 2)
+        self.assertEqual(stats['size'], 3)
+        self.assertEqual(stats['max_size'], 10)
+        self.assertEqual(stats['entries'], 1)